@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from logging import INFO, basicConfig, getLogger
+
+basicConfig(level=INFO)
+logger = getLogger(__name__)
+
+
+def classify(url: str, revision: str, path: str, save: bool, csv_path: str, id: str, timeout: float) -> int:
+    request = {
+        "revision": revision,
+        "path": os.path.abspath(os.path.expanduser(path)) if path else None,
+        "save": save,
+        "csv": os.path.abspath(csv_path),
+        "id": id,
+        "save_path": os.getcwd(),
+    }
+    req = urllib.request.Request(
+        f"{url.rstrip('/')}/classify",
+        data=json.dumps(request).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read())["returncode"]
+
+
+def main() -> None:
+    description = "Classify a commit with a running classification server (see test.py --serve)"
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8000", help="URL of the classification server.")
+    parser.add_argument(
+        "--path",
+        type=str,
+        default=None,
+        help="Path to the repository containing the revision. If not specified, use the server repository.",
+    )
+    parser.add_argument(
+        "--csv",
+        type=str,
+        default='./',
+        help="Path to csv.",
+    )
+    parser.add_argument(
+        "--id",
+        type=str,
+        default='',
+        help="Gerrit id.",
+    )
+    parser.add_argument("--revision", help="revision to analyze. If not specify, use the last commit.", type=str)
+    parser.add_argument("--save", action="store_true", help="Whether to write results to file.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the server.")
+
+    args = parser.parse_args()
+
+    try:
+        returncode = classify(args.url, args.revision, args.path, args.save, args.csv, args.id, args.timeout)
+    except (urllib.error.URLError, OSError) as e:
+        # Behave like a crash of test.py, so the patch takes the same track as before.
+        logger.error("Classification request failed: %s", e)
+        sys.exit(1)
+
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+from db import *
+
+
+def get_format(path):
+    """Get the serialization format of a database from its extensions."""
+    parts = os.path.basename(path).split('.')
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def get_size(path):
+    size = os.path.getsize(path)
+    if os.path.exists(f"{path}.index"):
+        size += os.path.getsize(f"{path}.index")
+    return size
+
+
+def benchmark(records, path, level, threads, dict_size=0):
+    start = time.monotonic()
+    write(records, path, level, threads, dict_size)
+    write_time = time.monotonic() - start
+
+    start = time.monotonic()
+    for _ in read(path):
+        pass
+    read_time = time.monotonic() - start
+
+    return get_size(path), write_time, read_time
+
+
+def main(inputs, levels, threads, dict_sizes, limit=None):
+    print(f"{'input':<32} {'output':<12} {'level':>5} {'threads':>7} {'dict':>7} {'size (MB)':>10} "
+          f"{'write (s)':>10} {'read (s)':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for input_path in inputs:
+            records = list(itertools.islice(read(input_path), limit))
+            db_format = get_format(input_path)
+
+            configs = [(f"{db_format}.zstd", level, thread_num, 0)
+                       for level, thread_num in itertools.product(levels, threads)]
+            configs += [("block", level, 0, dict_size) for level, dict_size in itertools.product(levels, dict_sizes)]
+
+            for extension, level, thread_num, dict_size in configs:
+                path = os.path.join(directory, f"benchmark.{extension}")
+                size, write_time, read_time = benchmark(records, path, level, thread_num, dict_size)
+                print(f"{os.path.basename(input_path):<32} {extension:<12} {level:>5} {thread_num:>7} {dict_size:>7} "
+                      f"{size / 1024 ** 2:>10.2f} {write_time:>10.2f} {read_time:>9.2f}")
+
+
+def benchmark_test_scheduling(repeat):
+    """Compare reading the sharded test scheduling data sequentially and with shards decompressed ahead."""
+    from dataset import test_history
+
+    print(f"{'reader':<12} {'records':>10} {'read (s)':>9}")
+    for parallel in [False, True] * repeat:
+        start = time.monotonic()
+        count = sum(1 for _ in test_history.read_test_scheduling(parallel))
+        print(f"{'parallel' if parallel else 'sequential':<12} {count:>10} {time.monotonic() - start:>9.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the size and speed of database compression settings')
+    parser.add_argument("inputs", type=str, nargs="*",
+                        default=["data/commits.json", "data/test_scheduling.pickle.zstd"], help="Input files")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 3, 9, 19], help="zstd levels")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, -1], help="zstd threads")
+    parser.add_argument("--dict-sizes", type=int, nargs="+", default=[0, 112640],
+                        help="Dictionary sizes for the block format")
+    parser.add_argument("--limit", type=int, default=None, help="Limit of the number of records of each input")
+    parser.add_argument("--test-scheduling", action="store_true",
+                        help="Instead, compare the sequential and parallel readers of the test scheduling data")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each test scheduling reader")
+    args = parser.parse_args()
+    if args.test_scheduling:
+        benchmark_test_scheduling(args.repeat)
+    else:
+        main(args.inputs, args.levels, args.threads, args.dict_sizes, args.limit)
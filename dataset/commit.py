@@ -1,9 +1,10 @@
 # Created by Baole Fang at 6/3/23
 import copy
+import csv
 import os
 import logging
 
-import pandas as pd
+import numpy as np
 from git import Commit
 from typing import *
 from dataset import rust_code_analysis_server
@@ -397,8 +398,26 @@ def get_touched_functions(
     return [functions[i] for i in touched_functions_indexes]
 
 
-def calculate_lines(commit, file):
-    diff = commit.parents[0].diff(commit, paths=[file], create_patch=True)[0]
+def get_diffs(commit) -> dict:
+    """Diff all the files of a commit at once, indexed by path.
+
+    Renamed or copied files are left out, so they are diffed alone like any file missing from the index.
+    """
+    diffs = {}
+    for diff in commit.parents[0].diff(commit, create_patch=True, no_renames=True):
+        if diff.a_path is not None and diff.b_path is not None and diff.a_path != diff.b_path:
+            continue
+        diffs.setdefault(diff.b_path or diff.a_path, diff)
+    return diffs
+
+
+def get_diff(commit, diffs: dict, file: str):
+    if file in diffs:
+        return diffs[file]
+    return commit.parents[0].diff(commit, paths=[file], create_patch=True)[0]
+
+
+def calculate_lines(diff):
     if diff.new_file:
         return [], [], True
     patch = diff.diff.decode('utf-8').splitlines()
@@ -423,15 +442,53 @@ def calculate_lines(commit, file):
     return delete_lines, add_lines, False
 
 
-def get_component_dict(path='data/bz_data.csv'):
-    result = {None: None}
-    data = pd.read_csv(path)
-    for bug_id, component in zip(data['id'], data['component']):
-        result[int(bug_id)] = component
-    return result
+BZ_DATA_PATH = 'data/bz_data.csv'
+
+
+class ComponentTable:
+    """Bugzilla components of bugs, read from the Bugzilla data on first use.
+
+    Bug ids are kept in a sorted numpy array, with the index of their component name in a
+    parallel array, so that the table is small and, when loaded before forking, shared with
+    the workers.
+    """
+
+    def __init__(self, path: str = BZ_DATA_PATH):
+        self.path = path
+        self.bug_ids = None
+        self.codes = None
+        self.names = None
+
+    def load(self) -> None:
+        if self.bug_ids is not None:
+            return
+
+        bug_ids = []
+        codes = []
+        names = {}
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader(f):
+                bug_ids.append(int(row['id']))
+                codes.append(names.setdefault(row['component'], len(names)))
+
+        bug_ids = np.array(bug_ids, dtype=np.int64)
+        # A stable sort keeps the last row of a bug last, so that it takes precedence.
+        order = np.argsort(bug_ids, kind='stable')
+        self.bug_ids = bug_ids[order]
+        self.codes = np.array(codes, dtype=np.min_scalar_type(max(len(names) - 1, 0)))[order]
+        self.names = list(names)
+
+    def get(self, bug_id: Optional[int]) -> Optional[str]:
+        if bug_id is None:
+            return None
+        self.load()
+        i = np.searchsorted(self.bug_ids, bug_id, side='right') - 1
+        if i < 0 or self.bug_ids[i] != bug_id:
+            return None
+        return self.names[self.codes[i]] or None
 
 
-COMPONENT = get_component_dict()
+COMPONENTS = ComponentTable()
 
 
 class Commit:
@@ -470,7 +527,7 @@ class Commit:
         self.functions: dict[str, list[dict]] = {}
         self.failures = failures
         self.components = []
-        components = COMPONENT.get(self.bug_id, None)
+        components = COMPONENTS.get(self.bug_id)
         if components:
             self.components.append(components)
 
@@ -578,9 +635,11 @@ class Commit:
         other_sizes = []
         test_sizes = []
         metrics_file_count = 0
+        source_code_files = []
+        diffs = get_diffs(commit)
 
         for file, count in commit.stats.files.items():
-            diff = commit.parents[0].diff(commit, paths=[file], create_patch=True)[0]
+            diff = get_diff(commit, diffs, file)
             after = None
             size = None
             if not diff.deleted_file:
@@ -600,22 +659,7 @@ class Commit:
                 if size:
                     source_code_sizes.append(size)
 
-                after_metrics = code_analysis_server.metrics(file, after, unit=False)
-                if after_metrics.get("spaces"):
-                    metrics_file_count += 1
-                    deleted_lines, added_lines, new_file = calculate_lines(commit, file)
-                    before_metrics = {}
-                    if not new_file:
-                        before = (commit.parents[0].tree / file).data_stream.read()
-                        before_metrics = code_analysis_server.metrics(file, before, unit=False)
-
-                    self.set_commit_metrics(
-                        file,
-                        deleted_lines,
-                        added_lines,
-                        before_metrics,
-                        after_metrics,
-                    )
+                source_code_files.append((file, after, diff))
 
             else:
                 self.other_added += count['insertions']
@@ -623,6 +667,36 @@ class Commit:
                 if size:
                     other_sizes.append(size)
 
+        # Analyze the versions after the commit of all source code files at once, and then the versions
+        # before the commit of the files whose metrics are used.
+        after_metrics = code_analysis_server.metrics_many(
+            [(file, after) for file, after, _ in source_code_files], unit=False
+        )
+        analyzed = [
+            (file, diff, metrics)
+            for (file, _, diff), metrics in zip(source_code_files, after_metrics)
+            if metrics.get("spaces")
+        ]
+        before_metrics = iter(code_analysis_server.metrics_many(
+            [
+                (file, (commit.parents[0].tree / file).data_stream.read())
+                for file, diff, _ in analyzed if not diff.new_file
+            ],
+            unit=False,
+        ))
+
+        for file, diff, metrics in analyzed:
+            metrics_file_count += 1
+            deleted_lines, added_lines, _ = calculate_lines(diff)
+
+            self.set_commit_metrics(
+                file,
+                deleted_lines,
+                added_lines,
+                next(before_metrics) if not diff.new_file else {},
+                metrics,
+            )
+
         self.seniority_author = 0.0
         self.total_source_code_file_size = sum(source_code_sizes)
         self.average_source_code_file_size = self.total_source_code_file_size / len(
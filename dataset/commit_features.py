@@ -3,10 +3,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import sys
+from array import array
 from collections import defaultdict
+from collections.abc import Iterable, Mapping
+from numbers import Number
 from typing import Sequence
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.base import BaseEstimator, TransformerMixin
 
 from dataset.commit import METRIC_NAMES
@@ -917,81 +922,112 @@ def merge_metrics(objects):
     return metrics
 
 
+# Keys of the commits which merge_commits reads, besides the optional "metrics".
+MERGE_COMMITS_COLUMNS = (
+    "node",
+    "pushdate",
+    "types",
+    "files",
+    "directories",
+    "components",
+    "reviewers",
+    "source_code_files_modified_num",
+    "other_files_modified_num",
+    "test_files_modified_num",
+    "total_source_code_file_size",
+    "maximum_source_code_file_size",
+    "minimum_source_code_file_size",
+    "total_other_file_size",
+    "maximum_other_file_size",
+    "minimum_other_file_size",
+    "total_test_file_size",
+    "maximum_test_file_size",
+    "minimum_test_file_size",
+    "source_code_added",
+    "other_added",
+    "test_added",
+    "source_code_deleted",
+    "other_deleted",
+    "test_deleted",
+)
+
+
 def merge_commits(commits: Sequence[dict]) -> dict:
-    return (
-        {
-            "nodes": list(commit["node"] for commit in commits),
-            "pushdate": commits[0]["pushdate"],
-            "types": list(set(sum((commit["types"] for commit in commits), []))),
-            "files": list(set(sum((commit["files"] for commit in commits), []))),
-            "directories": list(
-                set(sum((commit["directories"] for commit in commits), []))
-            ),
-            "components": list(
-                set(sum((commit["components"] for commit in commits), []))
-            ),
-            "reviewers": list(
-                set(sum((commit["reviewers"] for commit in commits), []))
-            ),
-            "source_code_files_modified_num": sum(
-                commit["source_code_files_modified_num"] for commit in commits
-            ),
-            "other_files_modified_num": sum(
-                commit["other_files_modified_num"] for commit in commits
-            ),
-            "test_files_modified_num": sum(
-                commit["test_files_modified_num"] for commit in commits
-            ),
-            "total_source_code_file_size": sum(
-                commit["total_source_code_file_size"] for commit in commits
-            ),
-            "average_source_code_file_size": sum(
-                commit["total_source_code_file_size"] for commit in commits
-            )
-            / len(commits),
-            "maximum_source_code_file_size": max(
-                commit["maximum_source_code_file_size"] for commit in commits
-            ),
-            "minimum_source_code_file_size": min(
-                commit["minimum_source_code_file_size"] for commit in commits
-            ),
-            "total_other_file_size": sum(
-                commit["total_other_file_size"] for commit in commits
-            ),
-            "average_other_file_size": sum(
-                commit["total_other_file_size"] for commit in commits
-            )
-            / len(commits),
-            "maximum_other_file_size": max(
-                commit["maximum_other_file_size"] for commit in commits
-            ),
-            "minimum_other_file_size": min(
-                commit["minimum_other_file_size"] for commit in commits
-            ),
-            "total_test_file_size": sum(
-                commit["total_test_file_size"] for commit in commits
-            ),
-            "average_test_file_size": sum(
-                commit["total_test_file_size"] for commit in commits
-            )
-            / len(commits),
-            "maximum_test_file_size": max(
-                commit["maximum_test_file_size"] for commit in commits
-            ),
-            "minimum_test_file_size": min(
-                commit["minimum_test_file_size"] for commit in commits
-            ),
-            "source_code_added": sum(commit["source_code_added"] for commit in commits),
-            "other_added": sum(commit["other_added"] for commit in commits),
-            "test_added": sum(commit["test_added"] for commit in commits),
-            "source_code_deleted": sum(
-                commit["source_code_deleted"] for commit in commits
-            ),
-            "other_deleted": sum(commit["other_deleted"] for commit in commits),
-            "test_deleted": sum(commit["test_deleted"] for commit in commits),
-            "metrics": merge_metrics(commits),
-        }
-    )
+    merged = {
+        "nodes": list(commit["node"] for commit in commits),
+        "pushdate": commits[0]["pushdate"],
+        "types": list(set(sum((commit["types"] for commit in commits), []))),
+        "files": list(set(sum((commit["files"] for commit in commits), []))),
+        "directories": list(
+            set(sum((commit["directories"] for commit in commits), []))
+        ),
+        "components": list(
+            set(sum((commit["components"] for commit in commits), []))
+        ),
+        "reviewers": list(
+            set(sum((commit["reviewers"] for commit in commits), []))
+        ),
+        "source_code_files_modified_num": sum(
+            commit["source_code_files_modified_num"] for commit in commits
+        ),
+        "other_files_modified_num": sum(
+            commit["other_files_modified_num"] for commit in commits
+        ),
+        "test_files_modified_num": sum(
+            commit["test_files_modified_num"] for commit in commits
+        ),
+        "total_source_code_file_size": sum(
+            commit["total_source_code_file_size"] for commit in commits
+        ),
+        "average_source_code_file_size": sum(
+            commit["total_source_code_file_size"] for commit in commits
+        )
+        / len(commits),
+        "maximum_source_code_file_size": max(
+            commit["maximum_source_code_file_size"] for commit in commits
+        ),
+        "minimum_source_code_file_size": min(
+            commit["minimum_source_code_file_size"] for commit in commits
+        ),
+        "total_other_file_size": sum(
+            commit["total_other_file_size"] for commit in commits
+        ),
+        "average_other_file_size": sum(
+            commit["total_other_file_size"] for commit in commits
+        )
+        / len(commits),
+        "maximum_other_file_size": max(
+            commit["maximum_other_file_size"] for commit in commits
+        ),
+        "minimum_other_file_size": min(
+            commit["minimum_other_file_size"] for commit in commits
+        ),
+        "total_test_file_size": sum(
+            commit["total_test_file_size"] for commit in commits
+        ),
+        "average_test_file_size": sum(
+            commit["total_test_file_size"] for commit in commits
+        )
+        / len(commits),
+        "maximum_test_file_size": max(
+            commit["maximum_test_file_size"] for commit in commits
+        ),
+        "minimum_test_file_size": min(
+            commit["minimum_test_file_size"] for commit in commits
+        ),
+        "source_code_added": sum(commit["source_code_added"] for commit in commits),
+        "other_added": sum(commit["other_added"] for commit in commits),
+        "test_added": sum(commit["test_added"] for commit in commits),
+        "source_code_deleted": sum(
+            commit["source_code_deleted"] for commit in commits
+        ),
+        "other_deleted": sum(commit["other_deleted"] for commit in commits),
+        "test_deleted": sum(commit["test_deleted"] for commit in commits),
+    }
+    # Commits read without their metrics column (e.g. for models which don't use them).
+    if "metrics" in commits[0]:
+        merged["metrics"] = merge_metrics(commits)
+    return merged
 
 
 class CommitExtractor(BaseEstimator, TransformerMixin):
@@ -1013,42 +1049,47 @@ class CommitExtractor(BaseEstimator, TransformerMixin):
 
         return self
 
-    def transform(self, commits):
-        results = []
+    def extract(self, commit):
+        """Yield the (feature name, value) couples of a commit."""
+        for feature_extractor in self.feature_extractors:
+            if "bug_features" in feature_extractor.__module__:
+                if not commit["bug"]:
+                    continue
 
-        for commit in commits():
-            data = {}
+                res = feature_extractor(commit["bug"])
+            elif "test_scheduling_features" in feature_extractor.__module__:
+                res = feature_extractor(commit["test_job"], commit=commit)
+            else:
+                res = feature_extractor(commit)
 
-            for feature_extractor in self.feature_extractors:
-                if "bug_features" in feature_extractor.__module__:
-                    if not commit["bug"]:
-                        continue
+            if res is None:
+                continue
 
-                    res = feature_extractor(commit["bug"])
-                elif "test_scheduling_features" in feature_extractor.__module__:
-                    res = feature_extractor(commit["test_job"], commit=commit)
-                else:
-                    res = feature_extractor(commit)
+            if hasattr(feature_extractor, "name"):
+                feature_extractor_name = feature_extractor.name
+            else:
+                feature_extractor_name = feature_extractor.__class__.__name__
 
-                if res is None:
-                    continue
+            if isinstance(res, dict):
+                for key, value in res.items():
+                    yield key, value
+                continue
 
-                if hasattr(feature_extractor, "name"):
-                    feature_extractor_name = feature_extractor.name
-                else:
-                    feature_extractor_name = feature_extractor.__class__.__name__
+            if isinstance(res, list):
+                for item in res:
+                    yield f"{item} in {feature_extractor_name}", True
+                continue
 
-                if isinstance(res, dict):
-                    for key, value in res.items():
-                        data[sys.intern(key)] = value
-                    continue
+            yield feature_extractor_name, res
 
-                if isinstance(res, list):
-                    for item in res:
-                        data[sys.intern(f"{item} in {feature_extractor_name}")] = True
-                    continue
+    def transform(self, commits):
+        results = []
+
+        for commit in commits():
+            data = {}
 
-                data[sys.intern(feature_extractor_name)] = res
+            for key, value in self.extract(commit):
+                data[sys.intern(key)] = value
 
             result = {"data": data}
             if "desc" in commit:
@@ -1058,3 +1099,123 @@ class CommitExtractor(BaseEstimator, TransformerMixin):
             results.append(result)
 
         return pd.DataFrame(results)
+
+
+class CommitVectorizer(CommitExtractor):
+    """Extract the features of commits straight into a matrix.
+
+    The output, including the feature order and names, is the same as
+    CommitExtractor followed by
+    ColumnTransformer([("data", DictVectorizer(dtype=dtype), "data")]), but the
+    values are written directly into the sparse matrix buffers instead of going
+    through a dict per commit and a DataFrame.
+    """
+
+    def __init__(self, feature_extractors, cleanup_functions, dtype=np.float32, separator="=",
+                 sparse_threshold=0.3):
+        assert len(cleanup_functions) == 0, "Text features are not supported"
+        super().__init__(feature_extractors, cleanup_functions)
+        self.dtype = dtype
+        self.separator = separator
+        self.sparse_threshold = sparse_threshold
+
+    def fit(self, x, y=None):
+        self.fit_transform(x)
+        return self
+
+    def fit_transform(self, x, y=None):
+        super().fit(x)
+
+        vocabulary = {}
+        values, indices, indptr = self._vectorize(x, vocabulary, True)
+
+        # Columns are numbered in order of appearance while reading, sort them by name.
+        self.feature_names_ = sorted(vocabulary)
+        self.vocabulary_ = {name: i for i, name in enumerate(self.feature_names_)}
+        map_index = np.empty(len(vocabulary), dtype=np.intc)
+        for name, i in vocabulary.items():
+            map_index[i] = self.vocabulary_[name]
+        indices = map_index[indices]
+
+        X = self._to_matrix(values, indices, indptr)
+
+        total = X.shape[0] * X.shape[1]
+        self.sparse_output_ = total == 0 or X.nnz / total < self.sparse_threshold
+
+        return X if self.sparse_output_ else X.toarray()
+
+    def transform(self, commits):
+        values, indices, indptr = self._vectorize(commits, self.vocabulary_, False)
+        X = self._to_matrix(values, indices, indptr)
+        return X if self.sparse_output_ else X.toarray()
+
+    def get_feature_names_out(self, input_features=None):
+        return np.asarray([f"data__{name}" for name in self.feature_names_], dtype=object)
+
+    def _vectorize(self, commits, vocabulary, fitting):
+        values = array("d")
+        indices = array("i")
+        indptr = array("l", [0])
+
+        def add(name, value):
+            i = vocabulary.get(name)
+            if i is None:
+                if not fitting:
+                    return
+                i = vocabulary[sys.intern(name)] = len(vocabulary)
+
+            indices.append(i)
+            values.append(float("nan") if value is None else value)
+
+        for commit in commits():
+            for key, value in self.extract(commit):
+                if isinstance(value, str):
+                    add(f"{key}{self.separator}{value}", 1)
+                elif isinstance(value, Number) or value is None:
+                    add(key, value)
+                elif not isinstance(value, Mapping) and isinstance(value, Iterable):
+                    # Like DictVectorizer, the repeated strings of an iterable are counted.
+                    counts = {}
+                    for item in value:
+                        if not isinstance(item, str):
+                            raise TypeError(
+                                f"Unsupported type {type(item)} in iterable value. "
+                                "Only iterables of string are supported."
+                            )
+                        counts[item] = counts.get(item, 0) + 1
+                    for item, count in counts.items():
+                        add(f"{key}{self.separator}{item}", count)
+                else:
+                    raise TypeError(f"Unsupported value Type {type(value)} for {key}: {value}.")
+
+            indptr.append(len(indices))
+
+        if len(indptr) == 1:
+            raise ValueError("Sample sequence X is empty.")
+
+        return (
+            np.frombuffer(values, dtype=np.float64).astype(self.dtype),
+            np.frombuffer(indices, dtype=np.intc),
+            np.frombuffer(indptr, dtype=np.int_),
+        )
+
+    def _to_matrix(self, values, indices, indptr):
+        X = sp.csr_matrix(
+            (values, indices, indptr), shape=(len(indptr) - 1, len(self.vocabulary_)), dtype=self.dtype
+        )
+        X.sort_indices()
+
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        if np.any((np.diff(X.indices) == 0) & (np.diff(rows) == 0)):
+            # The same feature was extracted twice for a commit (e.g. by two feature
+            # extractors): like in the dict built by CommitExtractor, the last value wins.
+            rows = np.repeat(np.arange(X.shape[0]), np.diff(indptr))
+            order = np.lexsort((indices, rows))
+            rows, indices, values = rows[order], indices[order], values[order]
+            last = np.ones(len(rows), dtype=bool)
+            last[:-1] = (rows[1:] != rows[:-1]) | (indices[1:] != indices[:-1])
+            X = sp.csr_matrix(
+                (values[last], (rows[last], indices[last])), shape=X.shape, dtype=self.dtype
+            )
+
+        return X
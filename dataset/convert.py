@@ -4,14 +4,19 @@ import argparse
 from db import *
 
 
-def convert(a, b):
+def convert(a, b, level=ZSTD_LEVEL, threads=ZSTD_THREADS, dict_size=0):
     obj = read(a)
-    write(obj, b)
+    write(obj, b, level, threads, dict_size)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert database format')
     parser.add_argument("input", type=str, help="Input file")
     parser.add_argument("output", type=str, help="Output file")
+    parser.add_argument("--level", type=int, default=ZSTD_LEVEL, help="zstd compression level")
+    parser.add_argument("--threads", type=int, default=ZSTD_THREADS,
+                        help="zstd compression threads, -1 for one per CPU")
+    parser.add_argument("--dict-size", type=int, default=0,
+                        help="Size of the zstd dictionary to train for the block format, 0 for none")
     args = parser.parse_args()
-    convert(args.input, args.output)
+    convert(args.input, args.output, args.level, args.threads, args.dict_size)
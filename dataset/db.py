@@ -1,6 +1,8 @@
 # Created by Baole Fang at 6/13/23
+import bisect
 import gzip
 import io
+import os
 import pickle
 from contextlib import contextmanager
 
@@ -8,6 +10,49 @@ import orjson
 import zstandard
 from dataset import experiences
 
+HAS_PYARROW = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    HAS_PYARROW = True
+except ImportError:
+    pass
+
+OPT_MSG_MISSING = "Optional dependency pyarrow is missing, install it with: pip install pyarrow"
+
+BLOCK_SIZE = 256
+# Records are pickled in batches of about PICKLE_BATCH_BYTES, and at most PICKLE_BATCH_SIZE records.
+PICKLE_BATCH_SIZE = 1024
+PICKLE_BATCH_BYTES = 64 * 1024
+PICKLE_BATCH_MARKER = b"db.PickleStore batch"
+ROW_GROUP_SIZE = 10000
+# zstd compression level and number of threads (0 to compress in the calling thread, -1 for one per CPU).
+ZSTD_LEVEL = 3
+ZSTD_THREADS = 0
+
+
+def project(elems, columns=None):
+    """Keep only the given keys of the records, if any."""
+    if columns is None:
+        yield from elems
+    else:
+        for elem in elems:
+            yield {column: elem[column] for column in columns}
+
+
+def has_null_type(type_) -> bool:
+    """Whether an inferred Arrow type has a part whose type is unknown, e.g. a column of None or of empty lists."""
+    if pa.types.is_null(type_):
+        return True
+    if pa.types.is_list(type_) or pa.types.is_large_list(type_):
+        return has_null_type(type_.value_type)
+    if pa.types.is_struct(type_):
+        return any(has_null_type(field.type) for field in type_)
+    return False
+
+
 class Store:
     def __init__(self, fh):
         self.fh = fh
@@ -18,30 +63,294 @@ class JSONStore(Store):
         for elem in elems:
             self.fh.write(orjson.dumps(elem) + b"\n")
 
-    def read(self):
-        for line in io.TextIOWrapper(self.fh, encoding="utf-8"):
-            yield orjson.loads(line)
+    def read(self, columns=None):
+        return project(
+            (orjson.loads(line) for line in io.TextIOWrapper(self.fh, encoding="utf-8")), columns
+        )
+
+
+def read_exactly(fh, size):
+    """Read size bytes, as reads of decompressing streams can return less than requested."""
+    chunks = []
+    while size > 0:
+        chunk = fh.read(size)
+        if not chunk:
+            raise EOFError("Truncated pickle batch")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
 
 
 class PickleStore(Store):
+    """Records pickled in batches.
+
+    Each batch is a header, `(PICKLE_BATCH_MARKER, payload size, buffer sizes)`, followed by the
+    list of records pickled with protocol 5 and by its out-of-band buffers (e.g. the data of
+    NumPy arrays), which are read without copying them through the pickle stream. The number
+    of records of a batch adapts to the size of the previous one, so that large records aren't
+    all kept in memory while small ones are batched by hundreds. Records pickled one by one,
+    as in files written before batches, are read too.
+    """
+
+    def __init__(self, fh, batch_size=PICKLE_BATCH_SIZE, batch_bytes=PICKLE_BATCH_BYTES):
+        super().__init__(fh)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+
+    def _write_batch(self, batch):
+        buffers = []
+        payload = pickle.dumps(batch, protocol=5, buffer_callback=buffers.append)
+        buffers = [buffer.raw() for buffer in buffers]
+        self.fh.write(pickle.dumps((PICKLE_BATCH_MARKER, len(payload), [len(buffer) for buffer in buffers])))
+        self.fh.write(payload)
+        for buffer in buffers:
+            self.fh.write(buffer)
+        return len(payload) + sum(len(buffer) for buffer in buffers)
+
     def write(self, elems):
+        batch = []
+        # Start with small batches, until the size of the records is known.
+        batch_size = min(16, self.batch_size)
         for elem in elems:
-            self.fh.write(pickle.dumps(elem))
+            batch.append(elem)
+            if len(batch) == batch_size:
+                size = self._write_batch(batch)
+                batch_size = min(max(self.batch_bytes * len(batch) // max(size, 1), 1), self.batch_size)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    def _read(self):
+        while True:
+            try:
+                elem = pickle.load(self.fh)
+            except EOFError:
+                return
+
+            if type(elem) is tuple and len(elem) == 3 and type(elem[0]) is bytes and elem[0] == PICKLE_BATCH_MARKER:
+                _, payload_size, buffer_sizes = elem
+                payload = read_exactly(self.fh, payload_size)
+                buffers = [read_exactly(self.fh, size) for size in buffer_sizes]
+                yield from pickle.loads(payload, buffers=buffers)
+            else:
+                yield elem
+
+    def read(self, columns=None):
+        return project(self._read(), columns)
+
+
+class ParquetStore(Store):
+    """Records as the rows of a Parquet file, with a column per key.
+
+    Only the requested columns are read. Columns of dicts (e.g. metrics) are stored as JSON
+    strings, and the types of the columns are inferred from the first `ROW_GROUP_SIZE` records.
+    Columns whose type can't be inferred from them (e.g. only None or empty lists) are stored
+    as JSON strings too, as they may hold anything later.
+    """
+
+    def __init__(self, fh):
+        if not HAS_PYARROW:
+            raise NotImplementedError(OPT_MSG_MISSING)
+        super().__init__(fh)
+        self.writer = None
+        self.json_columns = None
+
+    def _to_table(self, rows, names):
+        # Records are copied, as JSON columns are encoded.
+        return pa.Table.from_pydict({
+            name: [
+                orjson.dumps(row.get(name)).decode("utf-8") if name in self.json_columns else row.get(name)
+                for row in rows
+            ]
+            for name in names
+        })
+
+    def _write_rows(self, rows):
+        if self.writer is None:
+            names = list(dict.fromkeys(name for row in rows for name in row))
+            self.json_columns = [name for name in names if any(isinstance(row.get(name), dict) for row in rows)]
+            inferred = self._to_table(rows, names).schema
+            self.json_columns += [field.name for field in inferred if has_null_type(field.type)]
+            table = self._to_table(rows, names)
+            schema = table.schema.with_metadata({"json_columns": orjson.dumps(self.json_columns)})
+            self.writer = pq.ParquetWriter(self.fh, schema)
+        else:
+            names = self.writer.schema.names
+            new_names = {name for row in rows for name in row}.difference(names)
+            if new_names:
+                raise ValueError(f"Records have keys which the first {ROW_GROUP_SIZE} records don't have: "
+                                 f"{sorted(new_names)}")
+            # Casting checks that values fit, e.g. that no float is truncated into an integer column.
+            try:
+                table = self._to_table(rows, names).cast(self.writer.schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                raise ValueError(f"Records don't match the types of the first {ROW_GROUP_SIZE} records: {e}")
+        self.writer.write_table(table.replace_schema_metadata(self.writer.schema.metadata))
+
+    def write(self, elems):
+        rows = []
+        for elem in elems:
+            rows.append(elem)
+            if len(rows) == ROW_GROUP_SIZE:
+                self._write_rows(rows)
+                rows = []
+        if rows:
+            self._write_rows(rows)
+
+    def read(self, columns=None):
+        parquet_file = pq.ParquetFile(self.fh)
+        json_columns = orjson.loads(parquet_file.schema_arrow.metadata[b"json_columns"])
+        if columns is not None:
+            columns = list(columns)
+            json_columns = [column for column in json_columns if column in columns]
+        for batch in parquet_file.iter_batches(columns=columns):
+            for row in batch.to_pylist():
+                for column in json_columns:
+                    row[column] = orjson.loads(row[column])
+                yield row
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class BlockStore:
+    """Records in blocks of `block_size`, each pickled and compressed as its own zstd frame.
 
-    def read(self):
+    A sidecar index (`<path>.index`) keeps the offset of each block, and the record number of
+    each record by its `key` field (e.g. the node of commits), so a lookup only decompresses
+    the block of the record.
+
+    With `dict_size`, a zstd dictionary of up to that many bytes is trained on the records of
+    the first block and kept in the index, which makes small blocks compress much better.
+    """
+
+    def __init__(self, path, mode="rb", key="node", block_size=BLOCK_SIZE, level=ZSTD_LEVEL,
+                 threads=ZSTD_THREADS, dict_size=0):
+        self.path = path
+        self.index_path = f"{path}.index"
+        self.key = key
+        self.fh = None
+        self.buffer = []
+        self.cached_block = (None, None)
+        self.level = level
+        self.threads = threads
+        self.dict_size = dict_size
+
+        if "w" in mode or ("a" in mode and not os.path.exists(self.index_path)):
+            self.index = {"block_size": block_size, "key": key, "count": 0, "starts": [], "offsets": [], "keys": {},
+                          "dictionary": None}
+        else:
+            with open(self.index_path, "rb") as f:
+                self.index = pickle.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+            self.key = self.index["key"]
+
+        self.dictionary = None
+        if self.index.get("dictionary") is not None:
+            self.dictionary = zstandard.ZstdCompressionDict(self.index["dictionary"])
+        self.dctx = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+        if "w" in mode or "a" in mode:
+            self.fh = open(path, mode)
+            # Blocks are appended after the ones in the index, even if a previous write was interrupted.
+            self.fh.truncate(self.index["offsets"][-1][1] if self.index["offsets"] else 0)
+            self.fh.seek(0, io.SEEK_END)
+            self.cctx = zstandard.ZstdCompressor(level=level, threads=threads, dict_data=self.dictionary)
+
+    def _train_dictionary(self):
+        samples = [pickle.dumps(elem, protocol=pickle.HIGHEST_PROTOCOL) for elem in self.buffer]
         try:
-            while True:
-                yield pickle.load(self.fh)
-        except EOFError:
-            pass
+            self.dictionary = zstandard.train_dictionary(self.dict_size, samples, level=self.level)
+        except zstandard.ZstdError:
+            # Too few or too small records to train a dictionary on.
+            return
+        self.index["dictionary"] = self.dictionary.as_bytes()
+        self.cctx = zstandard.ZstdCompressor(level=self.level, threads=self.threads, dict_data=self.dictionary)
+        self.dctx = zstandard.ZstdDecompressor(dict_data=self.dictionary)
+
+    def __len__(self):
+        return self.index["count"] + len(self.buffer)
+
+    def write(self, elems):
+        for elem in elems:
+            if isinstance(elem, dict) and self.key in elem:
+                self.index["keys"][elem[self.key]] = len(self)
+            self.buffer.append(elem)
+            if len(self.buffer) == self.index["block_size"]:
+                self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.dict_size and self.index["count"] == 0 and self.dictionary is None:
+            self._train_dictionary()
+        data = self.cctx.compress(pickle.dumps(self.buffer, protocol=pickle.HIGHEST_PROTOCOL))
+        offset = self.fh.tell()
+        self.fh.write(data)
+        self.index["starts"].append(self.index["count"])
+        self.index["offsets"].append((offset, offset + len(data)))
+        self.index["count"] += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        if self.fh is None:
+            return
+        self.flush()
+        self.fh.close()
+        self.fh = None
+        # Replace the index atomically, so that it never points to missing blocks.
+        with open(f"{self.index_path}.tmp", "wb") as f:
+            f.write(zstandard.ZstdCompressor().compress(pickle.dumps(self.index, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+    def _read_block(self, block):
+        if self.cached_block[0] != block:
+            start, end = self.index["offsets"][block]
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start)
+            self.cached_block = (block, pickle.loads(self.dctx.decompress(data)))
+        return self.cached_block[1]
+
+    def _get_record(self, number):
+        block = bisect.bisect_right(self.index["starts"], number) - 1
+        return self._read_block(block)[number - self.index["starts"][block]]
+
+    def read(self, columns=None):
+        return project(self.range(), columns)
+
+    def range(self, start=0, stop=None):
+        """Iterate over the records from number start to stop (excluded)."""
+        stop = self.index["count"] if stop is None else min(stop, self.index["count"])
+        if start >= stop:
+            return
+        block = bisect.bisect_right(self.index["starts"], start) - 1
+        while block < len(self.index["starts"]) and self.index["starts"][block] < stop:
+            block_start = self.index["starts"][block]
+            records = self._read_block(block)
+            yield from records[max(start - block_start, 0):stop - block_start]
+            block += 1
+
+    def get(self, key):
+        """Get a record by its key, raising KeyError if there is none."""
+        return self._get_record(self.index["keys"][key])
+
+    def get_many(self, keys):
+        """Get the records of the keys which are in the store, as a dict from key to record."""
+        numbers = sorted((self.index["keys"][key], key) for key in set(keys) if key in self.index["keys"])
+        return {key: self._get_record(number) for number, key in numbers}
+
+    def keys(self):
+        return self.index["keys"].keys()
 
 
 COMPRESSION_FORMATS = ["gz", "zstd"]
-SERIALIZATION_FORMATS = {"json": JSONStore, "pickle": PickleStore}
+SERIALIZATION_FORMATS = {"json": JSONStore, "pickle": PickleStore, "block": BlockStore, "parquet": ParquetStore}
 
 
-@contextmanager
-def db_open(path: str, mode):
+def get_formats(path: str):
+    """Get the serialization and compression (or None) formats of a database from its extensions."""
     parts = path.split('.')
     assert len(parts) > 1, "Extension needed to figure out serialization format"
     if len(parts) == 2:
@@ -53,39 +362,95 @@ def db_open(path: str, mode):
 
     assert compression is None or compression in COMPRESSION_FORMATS
     assert db_format in SERIALIZATION_FORMATS
+    return db_format, compression
+
 
+@contextmanager
+def db_open(path: str, mode, level=ZSTD_LEVEL, threads=ZSTD_THREADS, dict_size=0):
+    """Open a database, with the serialization and compression formats given by its extensions.
+
+    Args:
+        level, threads: zstd compression level and number of threads, when writing.
+        dict_size: size of the zstd dictionary to train, for the block format.
+    """
+    db_format, compression = get_formats(path)
     store_constructor = SERIALIZATION_FORMATS[db_format]
 
-    if compression == "gz":
+    if db_format == "block":
+        assert compression is None, "Blocks are already compressed"
+        store = BlockStore(path, mode, level=level, threads=threads, dict_size=dict_size)
+        try:
+            yield store
+        finally:
+            store.close()
+    elif db_format == "parquet":
+        assert compression is None, "Parquet files are already compressed"
+        assert "a" not in mode, "Parquet files can't be appended to"
+        with open(path, mode) as f:
+            store = ParquetStore(f)
+            try:
+                yield store
+            finally:
+                store.close()
+    elif compression == "gz":
         with gzip.GzipFile(path, mode) as f:
             yield store_constructor(f)
     elif compression == "zstd":
         if "w" in mode or "a" in mode:
-            cctx = zstandard.ZstdCompressor()
+            cctx = zstandard.ZstdCompressor(level=level, threads=threads)
             with open(path, mode) as f:
                 with cctx.stream_writer(f) as writer:
                     yield store_constructor(writer)
         else:
             dctx = zstandard.ZstdDecompressor()
             with open(path, mode) as f:
-                with dctx.stream_reader(f) as reader:
+                # Appending adds a new frame, read them all.
+                with dctx.stream_reader(f, read_across_frames=True) as reader:
                     yield store_constructor(reader)
     else:
         with open(path, mode) as f:
             yield store_constructor(f)
 
 
-def write(obj, path):
-    with db_open(path, 'wb') as db:
+def write(obj, path, level=ZSTD_LEVEL, threads=ZSTD_THREADS, dict_size=0):
+    with db_open(path, 'wb', level, threads, dict_size) as db:
         db.write(obj)
 
 
-def read(path):
+def read(path, columns=None):
+    """Read the records of a database.
+
+    Args:
+        columns: if set, only read these keys of the records. Parquet files only decode them.
+    """
     with db_open(path, "rb") as db:
-        for elem in db.read():
+        for elem in db.read(columns):
             yield elem
 
 
-def append(obj, path):
-    with db_open(path, "ab") as db:
+def decompress(path) -> bytes:
+    """Read the serialized records of a json or pickle database, decompressed, to be decoded by `loads`."""
+    db_format, compression = get_formats(path)
+    assert db_format in ("json", "pickle"), "Only stream formats can be decoded from memory"
+    if compression == "gz":
+        with gzip.GzipFile(path, "rb") as f:
+            return f.read()
+    elif compression == "zstd":
+        dctx = zstandard.ZstdDecompressor()
+        with open(path, "rb") as f:
+            with dctx.stream_reader(f, read_across_frames=True) as reader:
+                return reader.read()
+    else:
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def loads(data: bytes, path, columns=None):
+    """Decode the records returned by `decompress(path)`."""
+    db_format, _ = get_formats(path)
+    yield from SERIALIZATION_FORMATS[db_format](io.BytesIO(data)).read(columns)
+
+
+def append(obj, path, level=ZSTD_LEVEL, threads=ZSTD_THREADS):
+    with db_open(path, "ab", level, threads) as db:
         db.write(obj)
@@ -1,8 +1,12 @@
 # Created by Baole Fang at 6/6/23
+import copy
+import itertools
 import logging
+from array import array
 from datetime import datetime
 from typing import Collection, Any, Union
 
+import numpy as np
 from tqdm import tqdm
 from collections import deque
 from dataset.commit import Commit
@@ -12,11 +16,18 @@ logger = logging.getLogger(__name__)
 EXPERIENCE_TIMESPAN = 90
 EXPERIENCE_TIMESPAN_TEXT = f"{EXPERIENCE_TIMESPAN}_days"
 
+EXPERIENCES_PATH = 'data/experiences.pickle.zstd'
+
 
 class Experiences:
     def __init__(self, save):
         self.save = save
         self.db_experiences = {}
+        # Last day (since the first push date) for which experiences were updated.
+        self.last_day = 0
+        # Number of commits which were given an id for the complex experiences.
+        self.commit_count = 0
+        self.mem_commit_count = 0
 
         if not save:
             self.mem_experiences = {}
@@ -31,11 +42,10 @@ class Experiences:
         if self.save:
             return self.db_experiences[key]
         else:
-            return (
-                self.mem_experiences[key]
-                if key in self.mem_experiences
-                else self.db_experiences[key]
-            )
+            if key not in self.mem_experiences:
+                # Queues are updated in place, keep the saved experiences untouched.
+                self.mem_experiences[key] = copy.deepcopy(self.db_experiences[key])
+            return self.mem_experiences[key]
 
     def __setitem__(self, key, value):
         if self.save:
@@ -43,6 +53,20 @@ class Experiences:
         else:
             self.mem_experiences[key] = value
 
+    def new_commit_id(self) -> int:
+        commit_id = self.commit_count + self.mem_commit_count
+        if self.save:
+            self.commit_count += 1
+        else:
+            self.mem_commit_count += 1
+        return commit_id
+
+    def reset(self):
+        """Forget the experiences of the commits processed without saving."""
+        if not self.save:
+            self.mem_experiences = {}
+            self.mem_commit_count = 0
+
 
 class ExpQueue:
     def __init__(self, start_day: int, maxlen: int, default: Any) -> None:
@@ -90,7 +114,7 @@ class ExpQueue:
             # is going to be the same, and the one we are adding now).
             range_end = min(day - self.last_day, self.list.maxlen) - 2
             if range_end > 0:
-                self.list.extend(last_val for _ in range(range_end))
+                self.list.extend(itertools.repeat(last_val, range_end))
 
             self.start_day = day - (self.list.maxlen - 1)
 
@@ -101,12 +125,117 @@ class ExpQueue:
         assert day == self.last_day
 
 
+class ExpCommits:
+    """The commits which touched an item, as increasing integer ids.
+
+    Commits are only ever appended, so the commits up to a day are a prefix of `ids`, and
+    `counts` only needs to keep the length of that prefix for the last days.
+    """
+
+    def __init__(self, start_day: int, maxlen: int) -> None:
+        self.ids = array("I")
+        self.counts = ExpQueue(start_day, maxlen, 0)
+
+    def __deepcopy__(self, memo):
+        result = ExpCommits.__new__(ExpCommits)
+        result.ids = array("I", self.ids)
+        result.counts = copy.deepcopy(self.counts)
+        return result
+
+    def since(self, day: int) -> array:
+        """Get the ids of the commits after the given day."""
+        return self.ids[self.counts[day]:]
+
+    def add(self, day: int, commit_id: int) -> None:
+        self.ids.append(commit_id)
+        self.counts[day] = len(self.ids)
+
+
+def count_distinct(commit_lists: Collection[array]) -> int:
+    commit_lists = [commit_list for commit_list in commit_lists if len(commit_list) > 0]
+    if len(commit_lists) == 0:
+        return 0
+    # The ids of an item are unique, so there is nothing to merge.
+    if len(commit_lists) == 1:
+        return len(commit_lists[0])
+    if sum(len(commit_list) for commit_list in commit_lists) < 256:
+        return len(set().union(*commit_lists))
+    return np.unique(np.concatenate([np.frombuffer(commit_list, dtype=np.uint32) for commit_list in commit_lists])).size
+
+
+def _encode_experience(value):
+    if isinstance(value, ExpQueue):
+        return "queue", value.start_day, value.default, tuple(value.list)
+    if isinstance(value, ExpCommits):
+        return "commits", value.ids.tobytes(), _encode_experience(value.counts)
+    return value
+
+
+def _decode_experience(value):
+    if isinstance(value, tuple):
+        if value[0] == "queue":
+            _, start_day, default, values = value
+            queue = ExpQueue(0, len(values), default)
+            queue.list.extend(values)
+            queue.start_day = start_day
+            return queue
+        if value[0] == "commits":
+            _, ids, counts = value
+            commits = ExpCommits.__new__(ExpCommits)
+            commits.ids = array("I")
+            commits.ids.frombytes(ids)
+            commits.counts = _decode_experience(counts)
+            return commits
+    return value
+
+
+def save_experiences(experiences: Experiences, first_pushdate: datetime, path: str = EXPERIENCES_PATH) -> None:
+    """Save the experiences, so that they can be updated with later commits."""
+    from dataset.db import write
+
+    # Queues are stored as plain tuples, so the file doesn't depend on how this module was imported.
+    write([{
+        "first_pushdate": first_pushdate,
+        "last_day": experiences.last_day,
+        "commit_count": experiences.commit_count,
+        "experiences": {
+            key: _encode_experience(value) for key, value in experiences.db_experiences.items()
+        },
+    }], path)
+
+
+def load_experiences(path: str = EXPERIENCES_PATH, save: bool = True) -> tuple[Experiences, datetime]:
+    """Load experiences saved by save_experiences.
+
+    Args:
+        save: if False, updates are only kept in memory until Experiences.reset.
+
+    Returns:
+        the experiences and the first push date they are relative to.
+    """
+    from dataset.db import read
+
+    state = next(read(path))
+    experiences = Experiences(save)
+    experiences.last_day = state["last_day"]
+    experiences.commit_count = state["commit_count"]
+    for key, value in state["experiences"].items():
+        experiences.db_experiences[key] = _decode_experience(value)
+    return experiences, state["first_pushdate"]
+
+
 def calculate_experiences(
-        commits: Collection[Commit], first_pushdate: datetime, save: bool = True
-) -> None:
+        commits: Collection[Commit], first_pushdate: datetime, save: bool = True, experiences: Experiences = None
+) -> Experiences:
+    """Set the experience features of commits, sorted by push date.
+
+    Args:
+        experiences: the experiences after the commits of a previous call, to resume from.
+    """
     logger.info("Analyzing seniorities from %d commits...", len(commits))
 
-    experiences = Experiences(save)
+    if experiences is None:
+        experiences = Experiences(save)
 
     for commit in tqdm(commits, desc='calculating experiences'):
         key = f"first_commit_time${commit.author}"
@@ -182,33 +311,33 @@ def calculate_experiences(
                 for i in range(len(items)):
                     exp_queues[i][day] = total_exps[i] + 1
 
+    def get_commits(exp_type: str, commit_type: str, item: str, day: int) -> ExpCommits:
+        key = get_key(exp_type, commit_type, item)
+        try:
+            return experiences[key]
+        except KeyError:
+            commits = ExpCommits(day, EXPERIENCE_TIMESPAN + 1)
+            experiences[key] = commits
+            return commits
+
     def update_complex_experiences(
-            experience_type: str, day: int, items: Collection[str]
+            experience_type: str, day: int, items: Collection[str], commit_id: int
     ) -> None:
         for commit_type in ("", "backout"):
-            exp_queues = tuple(
-                get_experience(experience_type, commit_type, item, day, tuple())
+            exp_commits = tuple(
+                get_commits(experience_type, commit_type, item, day)
                 for item in items
             )
-            all_commit_lists = tuple(exp_queues[i][day] for i in range(len(items)))
-            before_commit_lists = tuple(
-                exp_queues[i][day - EXPERIENCE_TIMESPAN] for i in range(len(items))
-            )
+            all_commit_lists = tuple(commits.ids for commits in exp_commits)
             timespan_commit_lists = tuple(
-                commit_list[len(before_commit_list):]
-                for commit_list, before_commit_list in zip(
-                    all_commit_lists, before_commit_lists
-                )
+                commits.since(day - EXPERIENCE_TIMESPAN) for commits in exp_commits
             )
 
-            all_commits = set(sum(all_commit_lists, tuple()))
-            timespan_commits = set(sum(timespan_commit_lists, tuple()))
-
             commit.set_experience(
                 experience_type,
                 commit_type,
                 "total",
-                len(all_commits),
+                count_distinct(all_commit_lists),
                 max(
                     (len(all_commit_list) for all_commit_list in all_commit_lists),
                     default=0,
@@ -222,7 +351,7 @@ def calculate_experiences(
                 experience_type,
                 commit_type,
                 EXPERIENCE_TIMESPAN_TEXT,
-                len(timespan_commits),
+                count_distinct(timespan_commit_lists),
                 max(
                     (
                         len(timespan_commit_list)
@@ -246,15 +375,18 @@ def calculate_experiences(
                     or commit_type == "backout"
                     # and commit.backedoutby
             ):
-                for i in range(len(items)):
-                    exp_queues[i][day] = all_commit_lists[i] + (commit.node,)
+                for commits in exp_commits:
+                    commits.add(day, commit_id)
 
     for i, commit in enumerate(tqdm(commits, desc='updating experiences')):
         # The push date is unreliable, e.g. 4d0e3037210dd03bdb21964a6a8c2e201c45794b was pushed after
         # 06b578dfadc9db8b683090e0e110ba75b84fb766, but it has an earlier push date.
         # We accept the unreliability as it is small enough.
         day = (commit.pushdate - first_pushdate).days
-        assert day >= 0
+        # Commits of a later call may have been pushed before the last ones we processed.
+        day = max(day, experiences.last_day)
+        if experiences.save:
+            experiences.last_day = day
 
         # When a file is moved/copied, copy original experience values to the copied path.
         for orig, copied in commit.file_copies.items():
@@ -277,6 +409,9 @@ def calculate_experiences(
             update_experiences("author", day, (commit.author,))
             update_experiences("reviewer", day, commit.reviewers)
 
-            update_complex_experiences("file", day, commit.files)
-            update_complex_experiences("directory", day, commit.directories)
-            # update_complex_experiences("component", day, commit.components)
+            commit_id = experiences.new_commit_id()
+            update_complex_experiences("file", day, commit.files, commit_id)
+            update_complex_experiences("directory", day, commit.directories, commit_id)
+            # update_complex_experiences("component", day, commit.components, commit_id)
+
+    return experiences
@@ -0,0 +1,279 @@
+import io
+import logging
+import os
+import subprocess
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from git.diff import Diff
+
+logger = logging.getLogger(__name__)
+
+
+class Actor(NamedTuple):
+    name: str
+    email: str
+
+
+class Blob:
+    def __init__(self, hexsha: str, data: bytes):
+        self.hexsha = hexsha
+        self.data = data
+
+    @property
+    def data_stream(self):
+        return io.BytesIO(self.data)
+
+
+class Tree:
+    def __init__(self, repo: "BatchRepo", hexsha: str):
+        self.repo = repo
+        self.hexsha = hexsha
+
+    def __truediv__(self, path: str) -> Blob:
+        return self.repo.blob(f"{self.hexsha}:{path}")
+
+
+class Stats:
+    def __init__(self, files: dict):
+        self.files = files
+
+
+class FileDiff:
+    """A file of a patch, with the attributes of GitPython's Diff used by dataset.commit.
+
+    Like GitPython's patch diffs, `change_type` is never set: the change type of each file is in
+    the commit stats instead, or given by `new_file`, `deleted_file` and `renamed_file`.
+    """
+
+    change_type = None
+
+    def __init__(self, a_path, b_path, new_file, deleted_file, diff=b""):
+        self.a_path = a_path
+        self.b_path = b_path
+        self.new_file = new_file
+        self.deleted_file = deleted_file
+        self.diff = diff
+
+    @property
+    def renamed_file(self) -> bool:
+        return self.a_path is not None and self.b_path is not None and self.a_path != self.b_path
+
+
+def _decode_path(path: Optional[bytes]) -> Optional[str]:
+    return path.decode("utf-8", "replace") if path is not None else None
+
+
+def parse_numstat(text: bytes) -> dict:
+    """Parse `--raw --numstat` output like GitPython's Stats, with the change type of each file from the raw lines."""
+    change_types = []
+    files = {}
+    for line in text.decode("utf-8", "replace").splitlines():
+        if not line:
+            continue
+        if line.startswith(":"):
+            change_types.append(line.split("\t", 1)[0][-1])
+            continue
+        insertions, deletions, path = line.split("\t", 2)
+        insertions = int(insertions) if insertions != "-" else 0
+        deletions = int(deletions) if deletions != "-" else 0
+        files[path.strip()] = {
+            "insertions": insertions,
+            "deletions": deletions,
+            "lines": insertions + deletions,
+            "change_type": change_types[len(files)],
+        }
+    return files
+
+
+def parse_patch(text: bytes) -> list[FileDiff]:
+    """Parse patch output, with the same headers and diff text as GitPython's Diff."""
+    diffs = []
+    previous_header = None
+    for header in Diff.re_header.finditer(text):
+        groups = header.groupdict()
+        if previous_header is not None:
+            diffs[-1].diff = text[previous_header.end():header.start()]
+
+        diffs.append(FileDiff(
+            _decode_path(Diff._pick_best_path(groups["a_path"], groups["rename_from"], groups["a_path_fallback"])),
+            _decode_path(Diff._pick_best_path(groups["b_path"], groups["rename_to"], groups["b_path_fallback"])),
+            bool(groups["new_file_mode"]),
+            bool(groups["deleted_file_mode"]),
+        ))
+        previous_header = header
+
+    if previous_header is not None:
+        diffs[-1].diff = text[previous_header.end():]
+
+    return diffs
+
+
+class BatchCommit:
+    """A commit read with `git cat-file --batch`, with the parts of GitPython's Commit used by dataset.commit."""
+
+    def __init__(self, repo: "BatchRepo", hexsha: str, data: bytes):
+        self.repo = repo
+        self.hexsha = hexsha
+        self.parent_shas = []
+
+        headers, _, message = data.partition(b"\n\n")
+        encoding = "utf-8"
+        for line in headers.split(b"\n"):
+            # Continuation lines of multi-line headers (e.g. gpgsig) start with a space.
+            if line.startswith(b" "):
+                continue
+            name, _, value = line.partition(b" ")
+            if name == b"tree":
+                self.tree = Tree(repo, value.decode())
+            elif name == b"parent":
+                self.parent_shas.append(value.decode())
+            elif name == b"author":
+                self.author, self.authored_datetime = self._parse_actor(value)
+            elif name == b"committer":
+                self.committer, self.committed_datetime = self._parse_actor(value)
+            elif name == b"encoding":
+                encoding = value.decode()
+
+        self.message = message.decode(encoding, "replace")
+        self._parents = None
+        self._stats = None
+
+    @staticmethod
+    def _parse_actor(value: bytes) -> tuple[Actor, datetime]:
+        value = value.decode("utf-8", "replace")
+        name, _, rest = value.partition(" <")
+        email, _, date = rest.rpartition("> ")
+        timestamp, offset = date.split(" ")
+        sign = -1 if offset.startswith("-") else 1
+        offset = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])) * sign
+        return Actor(name, email), datetime.fromtimestamp(int(timestamp), timezone(offset))
+
+    def __repr__(self):
+        return f'<BatchCommit "{self.hexsha}">'
+
+    @property
+    def summary(self) -> str:
+        return self.message.split("\n", 1)[0]
+
+    @property
+    def parents(self) -> list["BatchCommit"]:
+        if self._parents is None:
+            self._parents = [self.repo.commit(sha) for sha in self.parent_shas]
+        return self._parents
+
+    @property
+    def stats(self) -> Stats:
+        if self._stats is None:
+            if self.parent_shas:
+                files, _ = self.repo.changes(self.parent_shas[0], self.hexsha)
+            else:
+                files = parse_numstat(self.repo.git("diff-tree", "-r", "--root", "--raw", "--numstat", "--no-renames", self.hexsha,
+                                                    "--").split(b"\n", 1)[1])
+            self._stats = Stats(files)
+        return self._stats
+
+    def diff(self, other: "BatchCommit", paths=None, create_patch=False, no_renames=False) -> list[FileDiff]:
+        assert create_patch, "Only patch diffs are supported"
+
+        if paths is None and no_renames:
+            _, diffs = self.repo.changes(self.hexsha, other.hexsha)
+            return diffs
+
+        args = ["diff-tree", "-r", "--abbrev=40", "--full-index", "-p", "--no-color"]
+        args.append("--no-renames" if no_renames else "-M")
+        args += [self.hexsha, other.hexsha, "--"]
+        if paths is not None:
+            args += list(paths)
+        return parse_patch(self.repo.git(*args))
+
+
+class BatchRepo:
+    """Read objects of a repository through one persistent `git cat-file --batch` process.
+
+    The process is started lazily, so a BatchRepo created before forking gives each worker
+    process its own. The stats and the patch of a commit come from a single `git diff-tree`.
+    """
+
+    def __init__(self, path: str):
+        self.working_dir = os.path.abspath(os.path.expanduser(path))
+        self._proc = None
+        self._pid = None
+        # Changes of the last commits, as (parent, commit) -> (stats, diffs).
+        self._changes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_proc"] = None
+        state["_pid"] = None
+        return state
+
+    def _cat_file(self):
+        if self._proc is None or self._pid != os.getpid():
+            self._proc = subprocess.Popen(
+                ["git", "cat-file", "--batch"],
+                cwd=self.working_dir,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+            self._pid = os.getpid()
+        return self._proc
+
+    def read_object(self, rev: str) -> tuple[str, str, bytes]:
+        proc = self._cat_file()
+        proc.stdin.write(rev.encode("utf-8") + b"\n")
+        proc.stdin.flush()
+
+        header = proc.stdout.readline().rstrip(b"\n").split(b" ")
+        if len(header) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            raise ValueError(f"Object {rev} not found in {self.working_dir}")
+
+        hexsha, type_, size = header[0].decode(), header[1].decode(), int(header[2])
+        data = proc.stdout.read(size)
+        proc.stdout.read(1)
+        return hexsha, type_, data
+
+    def commit(self, rev: str) -> BatchCommit:
+        hexsha, type_, data = self.read_object(rev)
+        if type_ == "tag":
+            return self.commit(f"{hexsha}^{{commit}}")
+        if type_ != "commit":
+            raise ValueError(f"{rev} is a {type_}, not a commit")
+        return BatchCommit(self, hexsha, data)
+
+    def blob(self, rev: str) -> Blob:
+        try:
+            hexsha, type_, data = self.read_object(rev)
+        except ValueError:
+            raise KeyError(rev)
+        return Blob(hexsha, data)
+
+    def git(self, *args) -> bytes:
+        return subprocess.run(
+            ["git", *args], cwd=self.working_dir, stdout=subprocess.PIPE, check=True
+        ).stdout
+
+    def changes(self, parent: str, commit: str) -> tuple[dict, list[FileDiff]]:
+        """Get the numstat stats and the patch diffs between two commits, without rename detection."""
+        key = (parent, commit)
+        if key not in self._changes:
+            output = self.git(
+                "diff-tree", "-r", "--abbrev=40", "--full-index", "--no-color", "--no-renames", "--raw", "--numstat", "-p",
+                parent, commit, "--"
+            )
+            numstat, _, patch = output.partition(b"\n\n")
+            if numstat.startswith(b"diff --git "):
+                numstat, patch = b"", output
+
+            # Only the changes of the commit being transformed are needed.
+            if len(self._changes) >= 8:
+                self._changes.clear()
+            self._changes[key] = (parse_numstat(numstat), parse_patch(patch))
+        return self._changes[key]
+
+    def close(self):
+        if self._proc is not None and self._pid == os.getpid():
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc = None
@@ -0,0 +1,88 @@
+import logging
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+FETCH_BATCH_SIZE = 500
+FETCH_JOBS = 4
+
+
+class FetchManager:
+    """Fetch Gerrit refs into a repository with few `git fetch` invocations.
+
+    Refs are fetched in batches of `batch_size` refspecs, with up to `jobs` fetches running at
+    the same time. When a batch fails (e.g. one of its refs was deleted on the remote), it is
+    split in halves until the refs which can't be fetched are found. The refs which were fetched
+    and those which failed are recorded in `fetched` and `failed`.
+    """
+
+    def __init__(self, path: str, remote: Optional[str] = None, batch_size: int = FETCH_BATCH_SIZE,
+                 jobs: int = FETCH_JOBS):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.remote = remote if remote is not None else self._git("remote").split()[0]
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.fetched = set()
+        self.failed = set()
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+
+    def _git(self, *args, input: Optional[str] = None) -> str:
+        return subprocess.run(["git", *args], cwd=self.path, input=input, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, text=True, check=True).stdout
+
+    def missing(self, shas: Iterable[str]) -> set:
+        """Get which of the objects aren't in the repository, with a single `git cat-file --batch-check`."""
+        output = self._git("cat-file", "--batch-check", input="".join(f"{sha}\n" for sha in shas))
+        return {line.split(" ", 1)[0] for line in output.splitlines() if line.endswith(" missing")}
+
+    def _fetch_batch(self, refs: list) -> None:
+        with self._lock:
+            self.fetch_count += 1
+        try:
+            # Concurrent fetches would overwrite each other's FETCH_HEAD, which isn't used anyway.
+            self._git("fetch", "--quiet", "--no-write-fetch-head", self.remote, *refs)
+        except subprocess.CalledProcessError as e:
+            if len(refs) == 1:
+                logger.warning("Failed to fetch %s: %s", refs[0], e.stderr.strip())
+                with self._lock:
+                    self.failed.add(refs[0])
+                return
+            self._fetch_batch(refs[:len(refs) // 2])
+            self._fetch_batch(refs[len(refs) // 2:])
+        else:
+            with self._lock:
+                self.fetched.update(refs)
+
+    def fetch(self, refs: Iterable[str]) -> set:
+        """Fetch the refs.
+
+        Returns:
+            the refs which were fetched.
+        """
+        refs = list(dict.fromkeys(refs))
+        batches = [refs[i:i + self.batch_size] for i in range(0, len(refs), self.batch_size)]
+        if self.jobs > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(self.jobs) as executor:
+                list(executor.map(self._fetch_batch, batches))
+        else:
+            for batch in batches:
+                self._fetch_batch(batch)
+        return self.fetched.intersection(refs)
+
+    def fetch_missing(self, commits: Iterable[tuple[str, str]]) -> set:
+        """Fetch the refs of the commits which aren't in the repository.
+
+        Args:
+            commits: (ref, sha) pairs.
+
+        Returns:
+            the refs which were fetched.
+        """
+        commits = list(commits)
+        missing = self.missing(sha for _, sha in commits)
+        return self.fetch(ref for ref, sha in commits if sha in missing)
@@ -0,0 +1,150 @@
+import fcntl
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+import orjson
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+METRICS_CACHE_DIR = 'data/metrics_cache'
+METRICS_CACHE_SIZE = 4 * 1024 ** 3
+SIZE_FILE = 'size'
+LOCK_FILE = 'lock'
+# When the cache is full, evict entries until it is this fraction of its maximum size.
+EVICTION_RATIO = 0.9
+
+
+class MetricsCache:
+    """On-disk cache of rust-code-analysis results, one compressed JSON file per key.
+
+    Entries are evicted in least recently used order (hits refresh the modification time)
+    when the total size goes above `max_size` bytes. Several processes can share the same
+    directory, as entries are written atomically. The total size is kept in a `size` file,
+    updated under a lock, so that they all evict against the same total. The entries are only
+    scanned when that file is missing.
+    """
+
+    def __init__(self, path: str = METRICS_CACHE_DIR, max_size: int = METRICS_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        self.size_path = os.path.join(path, SIZE_FILE)
+        self.lock_path = os.path.join(path, LOCK_FILE)
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json.zst")
+
+    def _entries(self):
+        for directory in os.scandir(self.path):
+            if directory.is_dir():
+                for entry in os.scandir(directory.path):
+                    if entry.name.endswith(".json.zst"):
+                        yield entry
+
+    def _scan_size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    @contextmanager
+    def _lock(self):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_size(self) -> int:
+        """Read the total size, with the lock held."""
+        try:
+            with open(self.size_path, "r") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            size = self._scan_size()
+            self._write_size(size)
+            return size
+
+    def _write_size(self, size: int) -> None:
+        with open(self.size_path, "w") as f:
+            f.write(str(size))
+
+    @property
+    def size(self) -> int:
+        with self._lock():
+            return self._read_size()
+
+    def get(self, key: str):
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = orjson.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+        except (FileNotFoundError, zstandard.ZstdError, orjson.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value) -> None:
+        path = self._entry_path(key)
+        data = zstandard.ZstdCompressor().compress(orjson.dumps(value))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        with self._lock():
+            size = self._read_size()
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+
+            size += len(data)
+            if size > self.max_size:
+                size = self._evict()
+            self._write_size(size)
+
+    def evict(self) -> None:
+        with self._lock():
+            self._write_size(self._evict())
+
+    def _evict(self) -> int:
+        """Evict entries with the lock held, and get the new total size."""
+        entries = sorted(
+            ((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self._entries())
+        )
+        size = sum(size for _, size, _ in entries)
+
+        evicted = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_size * EVICTION_RATIO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            evicted += 1
+
+        logger.info("Evicted %d entries from the metrics cache", evicted)
+        return size
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": self.size,
+        }
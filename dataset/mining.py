@@ -5,28 +5,34 @@ from datetime import datetime
 
 import pytz
 from git import Repo
-from commit import Commit
+from gitdb.exc import BadName
+from commit import COMPONENTS, Commit
 import rust_code_analysis_server
+from metrics_cache import METRICS_CACHE_DIR, MetricsCache
+from git_batch import BatchRepo
+from git_fetch import FETCH_BATCH_SIZE, FETCH_JOBS, FetchManager
 from tqdm import tqdm
-from experiences import calculate_experiences
+from experiences import EXPERIENCES_PATH, calculate_experiences, load_experiences, save_experiences
 from multiprocessing import Pool
 import csv
+import itertools
+import lzma
 from collections import defaultdict
 from db import *
+import db
 import logging
 import argparse
+import threading
+import time
+from queue import Queue
 
 logger = logging.getLogger(__name__)
 
+MINING_STATE_PATH = 'data/mining_state.pickle.zstd'
 
-def fetch(repo: Repo, lines):
-    remote = repo.remotes[0]
-    for line in tqdm(lines):
-        remote.fetch(line[6])
 
-
-def _fetch(line):
-    REMOTE.fetch(line)
+def fetch(repo: Repo, lines, batch_size=FETCH_BATCH_SIZE, jobs=FETCH_JOBS):
+    return FetchManager(repo.working_dir, batch_size=batch_size, jobs=jobs).fetch(line[6] for line in lines)
 
 
 def read(lines, limit):
@@ -48,87 +54,249 @@ def read(lines, limit):
     return mapping
 
 
-def get_rows(filename):
-    with open(filename) as f:
-        file = csv.reader(f, delimiter='\t')
-        lines = list(file)[6:-1]
-    return lines
+def get_change_number(ref):
+    """Get the change number of a Gerrit ref (e.g. 152179 for refs/changes/79/152179/9), or None for other refs."""
+    parts = ref.split('/')
+    if len(parts) == 5 and parts[:2] == ['refs', 'changes'] and parts[3].isdigit():
+        return int(parts[3])
+    return None
 
 
-def _init_process(server, root) -> None:
-    global REPO, SERVER
-    REPO = Repo(root)
-    SERVER = server
+def is_old_change(line, min_change):
+    """Whether a line of the Jenkins stats is a push of a Gerrit change older than min_change.
 
+    Only lines with quotes are parsed with the csv module, the others are simply split on tabs.
+    """
+    if '"' in line:
+        fields = next(csv.reader([line], delimiter='\t'))
+    else:
+        fields = line.split('\t', 7)
+    if len(fields) < 8:
+        return False
+    change = get_change_number(fields[6])
+    return change is not None and change < min_change
 
-def _init_fetch(root) -> None:
-    global REMOTE
-    REMOTE = Repo(root).remotes[0]
 
+def get_lines(lines, min_change=None):
+    """Drop the footer line and, with min_change, the lines of older changes before they are parsed."""
+    # Keep one line behind, so that the footer is never yielded.
+    previous = next(lines, None)
+    for line in lines:
+        if min_change is None or not is_old_change(previous, min_change):
+            yield previous
+        previous = line
 
-def _init_repo(root) -> None:
-    global REPO, REMOTE
-    REPO = Repo(root)
-    REMOTE = REPO.remotes[0]
 
+def get_rows(filename, min_change=None):
+    """Read the rows of the Jenkins stats one at a time, skipping the 6 header rows and the footer row.
 
-def _transform(commit):
-    c = REPO.commit(commit.node)
-    try:
-        return commit.transform(c, SERVER)
-    except:
-        logger.debug(f'commit {commit.node} transform error')
-        return None
+    Each row of the stats is a line, so old rows are dropped before being parsed.
+
+    Args:
+        filename: path of the stats, which can be xz compressed (`.xz`).
+        min_change: if set, skip the rows of Gerrit changes with a lower number. They are still read,
+            as the stats aren't sorted by change.
+    """
+    opener = lzma.open if filename.endswith('.xz') else open
+    with opener(filename, 'rt') as f:
+        yield from csv.reader(get_lines(itertools.islice(f, 6, None), min_change), delimiter='\t')
 
 
-def _get(item):
-    key, value = item
+def open_repo(root, git_backend='gitpython'):
+    """Open the repository used to read commits: GitPython, or a shared `git cat-file --batch` reader."""
+    if git_backend == 'batch':
+        return BatchRepo(root)
+    return Repo(root)
+
+
+def _init_process(server, root, git_backend='gitpython', start_date=None) -> None:
+    global REPO, SERVER, START
+    REPO = open_repo(root, git_backend)
+    SERVER = server
+    START = start_date
+
+
+def _fetch_stage(fetch_manager, items, output, stats):
+    """Fetch the missing commits of the items, batch by batch, and pass the items on through the output queue."""
+    # Each batch is fetched by up to `jobs` parallel git fetch.
+    batch_size = fetch_manager.batch_size * fetch_manager.jobs
     try:
-        commit = Commit(REPO.commit(key[1]), list(value))
-    except:
-        REMOTE.fetch(key[0])
-        commit = Commit(REPO.commit(key[1]), list(value))
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            start_time = time.monotonic()
+            fetch_manager.fetch_missing(key for _, (key, _) in batch)
+            stats['fetch_time'] += time.monotonic() - start_time
+            for item in batch:
+                output.put(item)
+    except Exception as e:
+        stats['error'] = e
     finally:
-        return commit
+        output.put(None)
 
 
-def get_features(repo_path, limit=None, csv_path='data/jenkinsfullstats.csv', output_path="data/commits.json",
-                 save=True, single_process=False):
-    repo = Repo(repo_path)
+def _mine(item):
+    """Initialize the commit of an item and, if it was pushed after the start date, transform it.
 
-    rows = get_rows(csv_path)
-
-    raw = read(rows, limit)
+    Returns:
+        the index of the item, the push date (None before the start date or if the commit is missing),
+        the transformed commit (None if the transformation failed), and the time spent initializing
+        and transforming.
+    """
+    index, (key, value) = item
+    start_time = time.monotonic()
+    try:
+        c = REPO.commit(key[1])
+        commit = Commit(c, list(value))
+    except (ValueError, BadName) as e:
+        # The commit couldn't be fetched (e.g. its ref was deleted), skip the push.
+        logger.warning(f'skipping {key[0]}: {e}')
+        return index, None, None, time.monotonic() - start_time, 0.0
+    init_time = time.monotonic() - start_time
+    if START is not None and commit.pushdate < START:
+        return index, None, None, init_time, 0.0
+
+    pushdate = commit.pushdate
+    start_time = time.monotonic()
+    try:
+        commit = commit.transform(c, SERVER)
+    except:
+        logger.debug(f'commit {commit.node} transform error')
+        commit = None
+    return index, pushdate, commit, init_time, time.monotonic() - start_time
+
+
+def mine(root, items, server, git_backend='gitpython', start_date=None, single_process=False,
+         fetch_batch_size=FETCH_BATCH_SIZE, fetch_jobs=FETCH_JOBS, queue_size=2000):
+    """Mine the commits of the items with a pipeline of stages running at the same time.
+
+    A thread fetches the missing commits batch by batch, and a pool of workers initializes
+    and transforms the commits as soon as they are available. At most queue_size items are
+    waiting between the stages.
+
+    Returns:
+        the push dates of the commits after the start date, and their transformed commits
+        (None where the transformation failed), sorted by push date.
+    """
+    items = list(enumerate(items))
+    queue = Queue(queue_size)
+    fetch_manager = FetchManager(root, batch_size=fetch_batch_size, jobs=fetch_jobs)
+    fetch_stats = {'fetch_time': 0.0}
+    fetcher = threading.Thread(target=_fetch_stage, args=(fetch_manager, items, queue, fetch_stats), daemon=True)
+    start_time = time.monotonic()
+
+    # The pool reads its input as fast as it can, so the semaphore bounds the items being mined.
+    semaphore = threading.Semaphore(queue_size)
+
+    def produce():
+        while True:
+            semaphore.acquire()
+            item = queue.get()
+            if item is None:
+                return
+            yield item
+
+    # Read the components once, to share them with the workers.
+    COMPONENTS.load()
+
+    results = []
     if single_process:
-        commits = []
-        for item in tqdm(raw.items(), desc='initializing commits'):
-            commits.append(_get(item))
+        _init_process(server, root, git_backend, start_date)
+        fetcher.start()
+        for item in tqdm(produce(), total=len(items), desc='mining commits'):
+            results.append(_mine(item))
+            semaphore.release()
     else:
-        with Pool(os.cpu_count(), initializer=_init_repo, initargs=(repo_path,)) as p:
-            commits = list(tqdm(p.imap(_get, raw.items()), total=len(raw), desc='initializing commits'))
+        with Pool(os.cpu_count(), initializer=_init_process, initargs=(server, root, git_backend, start_date)) as p:
+            # Only start the thread once the workers are forked, as they could inherit locks it holds.
+            fetcher.start()
+            for result in tqdm(p.imap_unordered(_mine, produce()), total=len(items), desc='mining commits'):
+                results.append(result)
+                semaphore.release()
+    fetcher.join()
+    if 'error' in fetch_stats:
+        raise fetch_stats['error']
+    total_time = time.monotonic() - start_time
+
+    init_time = sum(result[3] for result in results)
+    transform_time = sum(result[4] for result in results)
+    logger.info(f'fetched {len(fetch_manager.fetched)} of {len(items)} refs with {fetch_manager.fetch_count} git fetch '
+                f'in {fetch_stats["fetch_time"]:.1f}s, {len(fetch_manager.failed)} failed')
+    logger.info(f'initialized {len(results)} commits in {init_time:.1f}s of worker time '
+                f'({len(results) / max(init_time, 1e-9):.1f} commits/s)')
+    transformed = sum(1 for result in results if result[1] is not None)
+    logger.info(f'transformed {transformed} commits in {transform_time:.1f}s of worker time '
+                f'({transformed / max(transform_time, 1e-9):.1f} commits/s)')
+    logger.info(f'mined {len(results)} pushes in {total_time:.1f}s ({len(results) / max(total_time, 1e-9):.1f} pushes/s)')
+
+    # Sort by push date, keeping the order of the items for equal dates.
+    results = sorted((result for result in results if result[1] is not None), key=lambda result: (result[1], result[0]))
+    return [result[1] for result in results], [result[2] for result in results]
+
+
+def load_state(path=MINING_STATE_PATH, experiences_path=EXPERIENCES_PATH):
+    """Load the state of the previous mining run: mined (change, githash) keys, experiences and first push date."""
+    if not os.path.exists(path) or not os.path.exists(experiences_path):
+        return None
+    state = next(db.read(path))
+    state["experiences"], state["first_pushdate"] = load_experiences(experiences_path)
+    return state
 
-    commits.sort(key=lambda x: x.pushdate)
 
-    commits=[c for c in commits if c.pushdate>=START_DATE]
+def get_features(repo_path, limit=None, csv_path='data/jenkinsfullstats.csv', output_path="data/commits.json",
+                 save=True, single_process=False, metrics_cache=METRICS_CACHE_DIR, git_backend='gitpython',
+                 incremental=False, state_path=MINING_STATE_PATH, experiences_path=EXPERIENCES_PATH,
+                 min_change=None, fetch_batch_size=FETCH_BATCH_SIZE, fetch_jobs=FETCH_JOBS):
+    """Mine the features of the pushes in the Jenkins stats.
+
+    Args:
+        min_change: only mine the pushes of Gerrit changes from this number on.
+        fetch_batch_size: number of missing refs fetched by one git fetch.
+        fetch_jobs: number of git fetch running at the same time.
+        incremental: only mine the rows which weren't mined by a previous run, resuming its experiences,
+            and append them to output_path.
+    """
+    rows = get_rows(csv_path, min_change)
 
-    first_pushdate = commits[0].pushdate
+    raw = read(rows, limit)
 
-    if single_process:
-        code_analysis_server = rust_code_analysis_server.RustCodeAnalysisServer(1)
-        for commit in tqdm(commits, desc='transforming commits'):
-            commit.transform(repo.commit(commit.node), code_analysis_server)
+    state = load_state(state_path, experiences_path) if incremental else None
+    if state is not None:
+        raw = {key: value for key, value in raw.items() if key not in state["keys"]}
+        logger.info("%d new pushes to mine", len(raw))
+        mined_keys = state["keys"] | set(raw)
+    else:
+        mined_keys = set(raw)
+
+    cache = MetricsCache(metrics_cache) if metrics_cache else None
+    code_analysis_server = rust_code_analysis_server.RustCodeAnalysisServer(1 if single_process else None, cache)
+    pushdates, commits = mine(repo_path, raw.items(), code_analysis_server, git_backend, START_DATE, single_process,
+                              fetch_batch_size, fetch_jobs)
+
+    if state is not None:
+        first_pushdate = state["first_pushdate"]
+        if len(pushdates) == 0:
+            code_analysis_server.terminate()
+            if save:
+                write([{"keys": mined_keys}], state_path)
+            return []
     else:
-        code_analysis_server = rust_code_analysis_server.RustCodeAnalysisServer()
-        with Pool(os.cpu_count(), initializer=_init_process, initargs=(code_analysis_server, repo_path)) as p:
-            commits = list(tqdm(p.imap(_transform, commits), total=len(commits), desc='transforming commits'))
+        first_pushdate = pushdates[0]
+
+    if single_process:
+        code_analysis_server.log_stats()
 
     code_analysis_server.terminate()
     commits = [commit for commit in commits if commit]
-    calculate_experiences(commits, first_pushdate, save)
+    experiences = calculate_experiences(commits, first_pushdate, save, state["experiences"] if state else None)
     for i in range(len(commits)):
         commits[i] = commits[i].to_dict()
     if save:
-        write(commits, output_path)
+        if state is not None:
+            append(commits, output_path)
+        else:
+            write(commits, output_path)
+        write([{"keys": mined_keys}], state_path)
+        save_experiences(experiences, first_pushdate, experiences_path)
     return commits
 
 
@@ -136,9 +304,27 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract features of gerrit pushes')
     parser.add_argument("--path", type=str, default="~/libreoffice", help="Path to libreoffice repository")
     parser.add_argument("--limit", type=int, default=None, help="Limit of the number of pushes")
-    parser.add_argument("--input", type=str, default="data/jenkinsfullstats.csv", help="Input path of jenkins stats")
+    parser.add_argument("--input", type=str, default="data/jenkinsfullstats.csv",
+                        help="Input path of jenkins stats, optionally xz compressed")
     parser.add_argument("--output", type=str, default="data/commits.json", help="Output path of commit features")
     parser.add_argument("--start", type=str, default="2020-01-01", help="Start date (%Y-%m-%d) of commits")
+    parser.add_argument("--min-change", type=int, default=None,
+                        help="Only read the stats of Gerrit changes from this number on")
+    parser.add_argument("--metrics-cache", type=str, default=METRICS_CACHE_DIR,
+                        help="Directory of the code metrics cache, empty to disable it")
+    parser.add_argument("--git-backend", type=str, default="gitpython", choices=["gitpython", "batch"],
+                        help="How to read git objects: GitPython, or one `git cat-file --batch` process per worker")
+    parser.add_argument("--fetch-batch-size", type=int, default=FETCH_BATCH_SIZE,
+                        help="Number of missing refs fetched with one git fetch")
+    parser.add_argument("--fetch-jobs", type=int, default=FETCH_JOBS,
+                        help="Number of git fetch running at the same time")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only mine pushes which weren't mined yet, and append them to the output")
+    parser.add_argument("--state", type=str, default=MINING_STATE_PATH, help="Path of the mined pushes")
+    parser.add_argument("--experiences", type=str, default=EXPERIENCES_PATH, help="Path of the experiences")
     args = parser.parse_args()
     START_DATE = pytz.UTC.localize(datetime.strptime(args.start, "%Y-%m-%d"))
-    data = get_features(args.path, args.limit, args.input, args.output)
+    data = get_features(args.path, args.limit, args.input, args.output, metrics_cache=args.metrics_cache,
+                        git_backend=args.git_backend, incremental=args.incremental, state_path=args.state,
+                        experiences_path=args.experiences, min_change=args.min_change,
+                        fetch_batch_size=args.fetch_batch_size, fetch_jobs=args.fetch_jobs)
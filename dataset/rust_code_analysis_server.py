@@ -3,19 +3,29 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import concurrent.futures
+import hashlib
 import logging
+import os
 import subprocess
+import threading
 import time
 from typing import Optional
 
 import requests
 
+from dataset.metrics_cache import MetricsCache
+
 import socket
 
 logger = logging.getLogger(__name__)
 
 START_RETRIES = 14
 HEADERS = {"Content-type": "application/octet-stream"}
+# Number of requests sent at the same time by metrics_many.
+MAX_CONCURRENT_REQUESTS = 8
+# Log latency statistics every this many requests.
+STATS_LOG_INTERVAL = 1000
 
 
 def get_free_tcp_port() -> int:
@@ -26,8 +36,26 @@ def get_free_tcp_port() -> int:
     return port
 
 
+def get_version() -> str:
+    try:
+        return subprocess.run(
+            ["rust-code-analysis-web", "--version"], capture_output=True, text=True
+        ).stdout.strip()
+    except FileNotFoundError:
+        return "unknown"
+
+
+def get_blob_sha(code: bytes) -> str:
+    """Get the git blob SHA of some content, without needing the repository."""
+    return hashlib.sha1(b"blob %d\0" % len(code) + code).hexdigest()
+
+
 class RustCodeAnalysisServer:
-    def __init__(self, thread_num: Optional[int] = None):
+    def __init__(self, thread_num: Optional[int] = None, cache: Optional[MetricsCache] = None):
+        self.cache = cache
+        self.version = get_version()
+        self._init_client()
+
         for _ in range(START_RETRIES):
             self.start_process(thread_num)
 
@@ -44,6 +72,40 @@ class RustCodeAnalysisServer:
         self.terminate()
         raise RuntimeError("Unable to run rust-code-analysis server")
 
+    def _init_client(self):
+        # Keep-alive sessions can't be shared between processes, so each worker process
+        # (and each thread of metrics_many) lazily creates its own.
+        self._local = threading.local()
+        self._executor = None
+        self._pid = os.getpid()
+        self._stats_lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("_local", "_executor", "_stats_lock"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_client()
+
+    def _check_pid(self):
+        # After a fork, the client state of the parent process is unusable.
+        if self._pid != os.getpid():
+            self._init_client()
+
+    @property
+    def session(self) -> requests.Session:
+        self._check_pid()
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
     @property
     def base_url(self):
         return f"http://127.0.0.1:{self.port}"
@@ -60,6 +122,9 @@ class RustCodeAnalysisServer:
             raise RuntimeError("rust-code-analysis is required for code analysis")
 
     def terminate(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+            self._executor = None
         if self.proc is not None:
             self.proc.terminate()
 
@@ -68,7 +133,7 @@ class RustCodeAnalysisServer:
 
     def ping(self):
         try:
-            r = requests.get(f"{self.base_url}/ping")
+            r = self.session.get(f"{self.base_url}/ping")
             return r.ok
         except requests.exceptions.ConnectionError:
             return False
@@ -84,10 +149,88 @@ class RustCodeAnalysisServer:
                 classes, functions, nested functions, ...
         """
         unit = 1 if unit else 0
+
+        key = None
+        if self.cache is not None and code is not None:
+            key = self.get_cache_key(filename, code, unit)
+            metrics = self.cache.get(key)
+            if metrics is not None:
+                return metrics
+
         url = f"{self.base_url}/metrics?file_name={filename}&unit={unit}"
-        r = requests.post(url, data=code, headers=HEADERS)
+        start = time.monotonic()
+        r = self.session.post(url, data=code, headers=HEADERS)
+        self._record(time.monotonic() - start, r.ok)
 
         if not r.ok:
             return {}
 
-        return r.json()
+        metrics = r.json()
+        if key is not None:
+            self.cache.put(key, metrics)
+        return metrics
+
+    def get_cache_key(self, filename, code, unit):
+        # The results contain the file name, so it is part of the key together with the content.
+        key = f"{self.version}\0{unit}\0{filename}\0{get_blob_sha(code)}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def metrics_many(self, files, unit=True):
+        """Get code metrics for several files, sending requests concurrently.
+
+        Args:
+            files: (filename, code) tuples
+            unit: see metrics
+
+        Returns:
+            the metrics of each file, in the same order.
+        """
+        if len(files) <= 1:
+            return [self.metrics(filename, code, unit) for filename, code in files]
+
+        self._check_pid()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS)
+
+        return list(self._executor.map(lambda file: self.metrics(*file, unit=unit), files))
+
+    def _record(self, latency, ok):
+        with self._stats_lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+            if self.calls % STATS_LOG_INTERVAL == 0:
+                self.log_stats()
+
+    def get_stats(self) -> dict:
+        stats = {
+            "calls": self.calls,
+            "errors": self.errors,
+            "average_latency": self.total_latency / self.calls if self.calls else 0.0,
+            "max_latency": self.max_latency,
+        }
+        if self.cache is not None:
+            stats.update({f"cache_{name}": value for name, value in self.cache.get_stats().items()})
+        return stats
+
+    def log_stats(self):
+        stats = self.get_stats()
+        logger.info(
+            "rust-code-analysis (pid %d): %d requests, %d errors, %.1fms average latency, %.1fms max latency",
+            os.getpid(),
+            stats["calls"],
+            stats["errors"],
+            stats["average_latency"] * 1000,
+            stats["max_latency"] * 1000,
+        )
+        if self.cache is not None:
+            logger.info(
+                "metrics cache (pid %d): %d hits, %d misses, %.1f%% hit rate",
+                os.getpid(),
+                stats["cache_hits"],
+                stats["cache_misses"],
+                stats["cache_hit_rate"] * 100,
+            )
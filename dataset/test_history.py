@@ -1,10 +1,17 @@
 # Created by Baole Fang at 6/12/23
 import argparse
+import glob
 import itertools
 import logging
+import multiprocessing as mp
+import os
+import pickle
 
 from tqdm import tqdm
-from collections import Counter
+from collections import Counter, deque
+
+import numpy as np
+
 from dataset.db import *
 from typing import Any, Generator
 from dataset.experiences import ExpQueue
@@ -12,12 +19,176 @@ from dataset.experiences import ExpQueue
 logger = logging.getLogger(__name__)
 
 HISTORICAL_TIMESPAN = 4500
+PAST_FAILURES_FORMAT = "past_failures/1"
+
+PAST_FAILURES_PATH = 'data/past_failures.pickle.zstd'
+FAILING_TOGETHER_STATS_PATH = 'data/failing_together_stats.pickle.zstd'
+TEST_SCHEDULING_PATH = 'data/test_scheduling.pickle.zstd'
+TEST_SCHEDULING_SHARD_PATH = 'data/test_scheduling-{:05d}.pickle.zstd'
+TEST_SCHEDULING_SHARD_GLOB = 'data/test_scheduling-*.pickle.zstd'
+TEST_SCHEDULING_INDEX_PATH = 'data/test_scheduling_index.json'
+# Number of shards read_test_scheduling decompresses ahead of the one being consumed.
+READ_PREFETCH_SHARDS = 2
+SHARD_COMMIT_FIELDS = ("node", "failures", "types", "files", "directories", "components")
 
 ALL_TESTS = list(read('data/tests.json'))
 
 
-def get_pushes(filename='data/commits.json', limit=None):
-    commits = list(read(filename))[:limit]
+class PastFailures:
+    """Past failure counters of all the `type$runnable$item` keys, stored in a single array.
+
+    Each key is interned to a row of `values`, a ring buffer of the cumulative number of
+    failures in the last `maxlen` buckets of 100 pushes, read and updated with the same
+    semantics as an ExpQueue. Other entries ("all_runnables", "push_num") are kept in `meta`.
+    """
+
+    def __init__(self, maxlen: int = int(HISTORICAL_TIMESPAN / 100) + 1, capacity: int = 1024):
+        self.maxlen = maxlen
+        self.keys = {}
+        self.meta = {}
+        self.values = np.zeros((capacity, maxlen), dtype=np.int32)
+        # Position of the oldest bucket of each row in the ring buffer.
+        self.heads = np.zeros(capacity, dtype=np.int16)
+        self.start_days = np.zeros(capacity, dtype=np.int32)
+
+    @classmethod
+    def from_dict(cls, past_failures: dict) -> "PastFailures":
+        """Rebuild the past failures from `to_dict`, or convert a legacy DB made of ExpQueue objects."""
+        if past_failures.get("format") == PAST_FAILURES_FORMAT:
+            result = cls(past_failures["maxlen"], capacity=0)
+            result.__setstate__({key: value for key, value in past_failures.items() if key != "format"})
+            return result
+
+        result = cls(capacity=max(len(past_failures), 1))
+        for key, value in past_failures.items():
+            if isinstance(value, ExpQueue):
+                row = result.add(key, value.last_day)
+                result.values[row] = list(value.list)
+            else:
+                result.meta[key] = value
+        return result
+
+    def to_dict(self) -> dict:
+        """Get the past failures as plain containers and arrays.
+
+        The DB is written by `python dataset/test_history.py`, where this class is `__main__.PastFailures`,
+        so it can't be pickled as is.
+        """
+        return {"format": PAST_FAILURES_FORMAT, **self.__getstate__()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys or key in self.meta
+
+    def __getitem__(self, key):
+        return self.meta[key]
+
+    def __setitem__(self, key, value):
+        self.meta[key] = value
+
+    def __getstate__(self):
+        # Don't store the unused capacity, and store counters with the smallest type which fits them.
+        state = self.__dict__.copy()
+        for name in ("values", "heads", "start_days"):
+            state[name] = state[name][:len(self.keys)]
+        state["values"] = state["values"].astype(np.min_scalar_type(state["values"].max(initial=0)))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.values = self.values.astype(np.int32)
+
+    def get_row(self, key: str):
+        return self.keys.get(key)
+
+    def add(self, key: str, day: int) -> int:
+        """Add an empty counter whose last bucket is `day`."""
+        row = len(self.keys)
+        if row == len(self.values):
+            capacity = max(2 * len(self.values), 1024)
+            self.values = np.concatenate((self.values, np.zeros_like(self.values, shape=(capacity - row, self.maxlen))))
+            self.heads = np.concatenate((self.heads, np.zeros_like(self.heads, shape=capacity - row)))
+            self.start_days = np.concatenate((self.start_days, np.zeros_like(self.start_days, shape=capacity - row)))
+        self.keys[key] = row
+        self.heads[row] = 0
+        self.start_days[row] = day - (self.maxlen - 1)
+        return row
+
+    def read(self, row: int, day: int) -> int:
+        start_day = int(self.start_days[row])
+        if day < start_day:
+            day = start_day
+
+        if day < 0:
+            return 0
+
+        index = min(day - start_day, self.maxlen - 1)
+        return int(self.values[row, (self.heads[row] + index) % self.maxlen])
+
+    def read_many(self, rows: np.ndarray, days: np.ndarray) -> np.ndarray:
+        """Read the counters of `rows` at each of `days`, as a rows x days array."""
+        start_days = self.start_days[rows][:, None]
+        days = np.maximum(np.asarray(days)[None, :], start_days)
+        indexes = np.minimum(days - start_days, self.maxlen - 1)
+        values = self.values[rows[:, None], (self.heads[rows][:, None] + indexes) % self.maxlen]
+        return np.where(days < 0, 0, values)
+
+    def write(self, row: int, day: int, value: int) -> None:
+        head = int(self.heads[row])
+        last_day = int(self.start_days[row]) + self.maxlen - 1
+        if day == last_day:
+            self.values[row, (head - 1) % self.maxlen] = value
+        elif day > last_day:
+            # Same as ExpQueue: the buckets between the last one and the new one are filled
+            # with the last value, except for one of them.
+            last_value = self.values[row, (head - 1) % self.maxlen]
+            filled = max(min(day - last_day, self.maxlen) - 2, 0)
+            self.values[row, (head + np.arange(filled)) % self.maxlen] = last_value
+            head = (head + filled) % self.maxlen
+            self.values[row, head] = value
+            self.heads[row] = (head + 1) % self.maxlen
+            self.start_days[row] = day - (self.maxlen - 1)
+        else:
+            assert False, "Can't insert in the past"
+
+
+class PastFailuresCache:
+    """Keep the past failures DB in memory, reloading it only when the file on disk changes."""
+
+    def __init__(self, path=PAST_FAILURES_PATH):
+        self.path = path
+        self.data = None
+        self.stat = None
+        # Number of times the DB was actually read from disk.
+        self.loads = 0
+
+    def get(self):
+        stat = os.stat(self.path)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if self.data is None or stat != self.stat:
+            self.data = next(read(self.path))
+            if isinstance(self.data, dict):
+                self.data = PastFailures.from_dict(self.data)
+            self.stat = stat
+            self.loads += 1
+        return self.data
+
+    def refresh(self):
+        self.data = None
+        self.stat = None
+
+
+PAST_FAILURES = PastFailuresCache()
+
+
+def iter_pushes(filename='data/commits.json', limit=None, columns=None):
+    return itertools.islice(read(filename, columns), limit)
+
+
+def get_pushes(filename='data/commits.json', limit=None, columns=None):
+    commits = list(iter_pushes(filename, limit, columns))
     # if group:
     #     for i in range(len(commits)):
     #         for j in range(len(commits[i]['failures'])):
@@ -33,63 +204,251 @@ def get_pushes(filename='data/commits.json', limit=None):
     return commits
 
 
+def get_failure_matrix(failing_tests: list, test_num: int) -> np.ndarray:
+    """Get a pushes x tests boolean matrix from the indexes of the failing tests of each push."""
+    failures = np.zeros((len(failing_tests), test_num), dtype=bool)
+    for i, indexes in enumerate(failing_tests):
+        failures[i, indexes] = True
+    return failures
+
+
+def count_failures(failures: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Count failures of each test and failures of each couple of tests in the same push."""
+    # Floating point products go through BLAS and are exact for any realistic number of pushes.
+    failures = failures.astype(np.float64)
+    count_single = np.rint(failures.sum(axis=0)).astype(np.int64)
+    count_both = np.rint(failures.T @ failures).astype(np.int64)
+    return count_single, count_both
+
+
+class FailingTogetherStats:
+    """Sufficient statistics of the failing together DB, which can be updated push by push.
+
+    Cumulative counts are checkpointed every `checkpoint_interval` pushes, so the
+    counts up to any past push are recovered by folding only the pushes since the
+    closest checkpoint.
+    """
+
+    def __init__(self, tests: list, checkpoint_interval: int = 1000):
+        self.tests = tests
+        self.test_index = {test: i for i, test in enumerate(tests)}
+        self.checkpoint_interval = checkpoint_interval
+        # Push cursor: the nodes of the known pushes, in order, and the indexes of their failing tests.
+        self.nodes = []
+        self.node_index = {}
+        self.failing_tests = []
+        # Counts over the first `folded` pushes.
+        self.folded = 0
+        self.count_single = np.zeros(len(tests), dtype=np.int64)
+        self.count_both = np.zeros((len(tests), len(tests)), dtype=np.int64)
+        self.checkpoints = {}
+
+    def to_dict(self) -> dict:
+        """Get the statistics as plain containers and arrays, like PastFailures.to_dict."""
+        self.flush()
+        return {
+            "tests": self.tests,
+            "checkpoint_interval": self.checkpoint_interval,
+            "nodes": self.nodes,
+            "failing_tests": self.failing_tests,
+            "count_single": self.count_single,
+            "count_both": self.count_both,
+            "checkpoints": self.checkpoints,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "FailingTogetherStats":
+        stats = cls(state["tests"], state["checkpoint_interval"])
+        stats.nodes = state["nodes"]
+        for i, node in enumerate(stats.nodes):
+            stats.node_index.setdefault(node, i)
+        stats.failing_tests = state["failing_tests"]
+        stats.folded = len(stats.nodes)
+        stats.count_single = state["count_single"]
+        stats.count_both = state["count_both"]
+        stats.checkpoints = state["checkpoints"]
+        return stats
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, commit: dict) -> None:
+        indexes = [self.test_index[failure] for failure in commit['failures'] if failure in self.test_index]
+        self.node_index.setdefault(commit['node'], len(self.nodes))
+        self.nodes.append(commit['node'])
+        self.failing_tests.append(indexes)
+
+        if len(self.nodes) % self.checkpoint_interval == 0:
+            self.flush()
+            self.checkpoints[len(self.nodes)] = (self.count_single.copy(), self.count_both.copy())
+
+    def feed(self, push_num: int, commit: dict) -> bool:
+        """Add the push at position `push_num` of the history, unless it is already known.
+
+        Returns:
+            whether the statistics changed.
+        """
+        if push_num < len(self.nodes):
+            if self.nodes[push_num] == commit['node']:
+                return False
+            # History was rewritten, forget everything from this push.
+            self.truncate(push_num)
+
+        self.add(commit)
+        return True
+
+    def update(self, push_data) -> None:
+        for commit in push_data:
+            self.add(commit)
+        self.flush()
+
+    def flush(self) -> None:
+        """Fold the pushes added since the last call into the counts."""
+        if self.folded == len(self.nodes):
+            return
+
+        count_single, count_both = count_failures(
+            get_failure_matrix(self.failing_tests[self.folded:], len(self.tests))
+        )
+        self.count_single += count_single
+        self.count_both += count_both
+        self.folded = len(self.nodes)
+
+    def counts(self, end: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """Get the counts over the first `end` pushes."""
+        self.flush()
+
+        if end is None or end >= len(self.nodes):
+            return self.count_single, self.count_both
+
+        start = end - end % self.checkpoint_interval
+        if start == 0:
+            count_single = np.zeros(len(self.tests), dtype=np.int64)
+            count_both = np.zeros((len(self.tests), len(self.tests)), dtype=np.int64)
+        else:
+            count_single, count_both = self.checkpoints[start]
+
+        single, both = count_failures(get_failure_matrix(self.failing_tests[start:end], len(self.tests)))
+        return count_single + single, count_both + both
+
+    def truncate(self, end: int) -> None:
+        """Forget all the pushes after the first `end`."""
+        self.count_single, self.count_both = (counts.copy() for counts in self.counts(end))
+        for node in self.nodes[end:]:
+            if self.node_index[node] >= end:
+                del self.node_index[node]
+        del self.nodes[end:]
+        del self.failing_tests[end:]
+        self.folded = len(self.nodes)
+        self.checkpoints = {i: counts for i, counts in self.checkpoints.items() if i <= end}
+
+
+def load_failing_together_stats(path: str = FAILING_TOGETHER_STATS_PATH) -> FailingTogetherStats:
+    tests = sorted(ALL_TESTS)
+    if os.path.exists(path):
+        try:
+            stats = FailingTogetherStats.from_dict(next(read(path)))
+        except (AttributeError, TypeError, KeyError):
+            # Statistics pickled as objects by older versions, which can't always be loaded.
+            logger.warning("Failed to load the failing together statistics, recalculating them")
+        else:
+            # The statistics are useless if the set of tests changed.
+            if stats.tests == tests:
+                return stats
+    return FailingTogetherStats(tests)
+
+
+def update_failing_together_stats(
+        push_data, path: str = FAILING_TOGETHER_STATS_PATH
+) -> tuple[FailingTogetherStats, int]:
+    """Fold the pushes which are not in the stored statistics yet.
+
+    Returns:
+        the statistics and the number of pushes in push_data.
+    """
+    stats = load_failing_together_stats(path)
+
+    push_num = 0
+    changed = False
+    for commit in tqdm(push_data, desc='calculating probability'):
+        changed |= stats.feed(push_num, commit)
+        push_num += 1
+
+    if changed or not os.path.exists(path):
+        write([stats.to_dict()], path)
+
+    return stats, push_num
+
+
+def write_failing_together_probabilities(
+        granularity: str,
+        stats: FailingTogetherStats,
+        run_count: int,
+        up_to: str = None,
+) -> None:
+    end = run_count
+    if up_to is not None and up_to in stats.node_index:
+        end = min(end, stats.node_index[up_to] + 1)
+    count_single, count_both = stats.counts(end)
+
+    failing_together = calculate_failing_together(granularity, stats.tests, run_count, count_single, count_both)
+    write([failing_together], 'data/failing_together.pickle.zstd')
+
+
 def generate_failing_together_probabilities(
         granularity: str,
-        push_data: list,
+        push_data,
         up_to: str = None,
 ) -> None:
-    # `task2 failure -> task1 failure` separately, as they could be different.
+    stats, run_count = update_failing_together_stats(push_data)
+    write_failing_together_probabilities(granularity, stats, run_count, up_to)
 
-    count_runs = Counter()
-    count_single_failures = Counter()
-    count_both_failures = Counter()
 
-    for task1, task2 in itertools.combinations(sorted(ALL_TESTS), 2):
-        count_runs[(task1, task2)] = len(push_data)
+def calculate_failing_together(
+        granularity: str,
+        tests: list,
+        run_count: int,
+        count_single: np.ndarray,
+        count_both: np.ndarray,
+) -> dict:
+    # `task2 failure -> task1 failure` separately, as they could be different.
+    # Couples are (task1, task2) with task1 < task2, in the order of tests.
+    task1_indexes, task2_indexes = np.triu_indices(len(tests), 1)
 
-    def count_runs_and_failures(failures):
-        for failure in failures:
-            for task in ALL_TESTS:
-                if failure < task:
-                    count_single_failures[(failure, task)] += 1
-                elif failure > task:
-                    count_single_failures[(task, failure)] += 1
-        for task1, task2 in itertools.combinations(sorted(failures), 2):
-            count_both_failures[(task1, task2)] += 1
-            count_single_failures[(task1, task2)] -= 2
+    failure_counts = count_both[task1_indexes, task2_indexes]
+    # Pushes where only one of the two tasks failed.
+    single_failure_counts = (
+            count_single[task1_indexes] + count_single[task2_indexes] - 2 * failure_counts
+    )
+    supports = failure_counts / run_count
+
+    # At manifest-level, consider failures to be platform independent unless
+    # proven otherwise.
+    confidences = np.zeros(len(failure_counts))
+    if granularity == "config_group":
+        confidences[single_failure_counts == 0] = 1.0
+    np.divide(
+        failure_counts,
+        single_failure_counts + failure_counts,
+        out=confidences,
+        where=failure_counts != 0,
+    )
 
     all_available_configs = ALL_TESTS
 
-    for commit in tqdm(push_data, desc='calculating probability'):
-        failures = commit['failures']
-        count_runs_and_failures(failures)
-        if up_to is not None and commit['node'] == up_to:
-            break
-
     stats = {}
 
     skipped = 0
 
-    for couple, run_count in count_runs.most_common():
-        failure_count = count_both_failures[couple]
-        single_failure_count = count_single_failures[couple]
-        support = failure_count / run_count
-
+    for task1, task2, support, confidence in zip(
+            task1_indexes.tolist(), task2_indexes.tolist(), supports.tolist(), confidences.tolist()
+    ):
         # At manifest-level, don't filter based on support.
         # if granularity != "config_group" and support < 1 / 700:
         #     skipped += 1
         #     continue
 
-        # At manifest-level, consider failures to be platform independent unless
-        # proven otherwise.
-        if failure_count != 0:
-            confidence = failure_count / (single_failure_count + failure_count)
-        elif single_failure_count == 0 and granularity == "config_group":
-            confidence = 1.0
-        else:
-            confidence = 0.0
-
-        stats[couple] = (support, confidence)
+        stats[(tests[task1], tests[task2])] = (support, confidence)
 
     logger.info("%d couples skipped because their support was too low", skipped)
 
@@ -97,8 +456,7 @@ def generate_failing_together_probabilities(
     for couple, (support, confidence) in sorted(
             stats.items(), key=lambda k: (-k[1][1], -k[1][0])
     )[:7]:
-        failure_count = count_both_failures[couple]
-        run_count = count_runs[couple]
+        failure_count = count_both[tests.index(couple[0]), tests.index(couple[1])]
         logger.info(
             "%s - %s redundancy confidence %f, support %d (%d over %d).",
             couple[0],
@@ -113,8 +471,7 @@ def generate_failing_together_probabilities(
     for couple, (support, confidence) in sorted(
             stats.items(), key=lambda k: (-k[1][1], k[1][0])
     )[:7]:
-        failure_count = count_both_failures[couple]
-        run_count = count_runs[couple]
+        failure_count = count_both[tests.index(couple[0]), tests.index(couple[1])]
         logger.info(
             "%s - %s redundancy confidence %f, support %d (%d over %d).",
             couple[0],
@@ -175,7 +532,7 @@ def generate_failing_together_probabilities(
 
     failing_together["$ALL_CONFIGS$"] = all_available_configs
 
-    write([failing_together], 'data/failing_together.pickle.zstd')
+    return failing_together
 
 
 def _read_and_update_past_failures(
@@ -187,31 +544,28 @@ def _read_and_update_past_failures(
     values_prev_2800 = []
 
     key = f"{type_}${runnable}$"
+    day = round(push_num / 100)
 
     for item in items:
         full_key = key + item
 
-        is_new = full_key not in past_failures
+        row = past_failures.get_row(full_key)
 
-        if is_new:
+        if row is None:
             if not is_regression:
                 continue
 
-            cur = ExpQueue(round(push_num / 100), int(HISTORICAL_TIMESPAN / 100) + 1, 0)
-        else:
-            cur = past_failures[full_key]
+            row = past_failures.add(full_key, day)
 
-        value = cur[round(push_num / 100)]
+        value = past_failures.read(row, day)
 
         values_total.append(value)
-        values_prev_700.append(value - cur[round((push_num - 700) / 100)])
-        values_prev_1400.append(value - cur[round((push_num - 1400) / 100)])
-        values_prev_2800.append(value - cur[round((push_num - 2800) / 100)])
+        values_prev_700.append(value - past_failures.read(row, round((push_num - 700) / 100)))
+        values_prev_1400.append(value - past_failures.read(row, round((push_num - 1400) / 100)))
+        values_prev_2800.append(value - past_failures.read(row, round((push_num - 2800) / 100)))
 
         if is_regression:
-            cur[round(push_num / 100)] = value + 1
-            if is_new:
-                past_failures[full_key] = cur
+            past_failures.write(row, day, value + 1)
 
     return (
         sum(values_total),
@@ -221,80 +575,97 @@ def _read_and_update_past_failures(
     )
 
 
+def _read_past_failures(
+        past_failures, runnables, items_by_type, push_num
+) -> list[list[tuple[int, int, int, int]]]:
+    """Same as _read_and_update_past_failures for runnables which didn't fail, for all of them at once."""
+    rows = []
+    groups = []
+    for i, runnable in enumerate(runnables):
+        for j, (type_, items) in enumerate(items_by_type):
+            key = f"{type_}${runnable}$"
+            for item in items:
+                row = past_failures.get_row(key + item)
+                if row is not None:
+                    rows.append(row)
+                    groups.append(i * len(items_by_type) + j)
+
+    counts = np.zeros((len(runnables) * len(items_by_type), 4), dtype=np.int64)
+    if len(rows) > 0:
+        days = [round(push_num / 100)] + [round((push_num - prev) / 100) for prev in (700, 1400, 2800)]
+        values = past_failures.read_many(np.array(rows), np.array(days)).astype(np.int64)
+        values[:, 1:] = values[:, :1] - values[:, 1:]
+        np.add.at(counts, np.array(groups), values)
+
+    counts = [tuple(c) for c in counts.tolist()]
+    return [counts[i * len(items_by_type):(i + 1) * len(items_by_type)] for i in range(len(runnables))]
+
+
 def generate_data(
-        past_failures: dict,
+        past_failures: PastFailures,
         commit: dict,
         push_num: int,
         runnables: list,
         failures: list
 ):
-    for runnable in runnables:
-        is_regression = runnable in failures
-
-        (
-            total_failures,
-            past_700_pushes_failures,
-            past_1400_pushes_failures,
-            past_2800_pushes_failures,
-        ) = _read_and_update_past_failures(
-            past_failures, "all", runnable, ("all",), push_num, is_regression
-        )
+    items_by_type = (
+        ("all", ("all",)),
+        ("type", commit["types"]),
+        ("file", commit["files"]),
+        ("directory", commit["directories"]),
+        ("component", commit["components"]),
+    )
 
-        (
-            total_types_failures,
-            past_700_pushes_types_failures,
-            past_1400_pushes_types_failures,
-            past_2800_pushes_types_failures,
-        ) = _read_and_update_past_failures(
-            past_failures,
-            "type",
-            runnable,
-            commit["types"],
-            push_num,
-            is_regression,
-        )
+    # Counters are only updated on regressions and keys of different runnables never overlap,
+    # so the counters of all the runnables which didn't fail can be read at once.
+    passed_runnables = [runnable for runnable in runnables if runnable not in failures]
+    passed_counts = dict(
+        zip(passed_runnables, _read_past_failures(past_failures, passed_runnables, items_by_type, push_num))
+    )
 
-        (
-            total_files_failures,
-            past_700_pushes_files_failures,
-            past_1400_pushes_files_failures,
-            past_2800_pushes_files_failures,
-        ) = _read_and_update_past_failures(
-            past_failures,
-            "file",
-            runnable,
-            commit["files"],
-            push_num,
-            is_regression,
-        )
+    for runnable in runnables:
+        is_regression = runnable in failures
 
-        (
-            total_directories_failures,
-            past_700_pushes_directories_failures,
-            past_1400_pushes_directories_failures,
-            past_2800_pushes_directories_failures,
-        ) = _read_and_update_past_failures(
-            past_failures,
-            "directory",
-            runnable,
-            commit["directories"],
-            push_num,
-            is_regression,
-        )
+        if is_regression:
+            counts = [
+                _read_and_update_past_failures(past_failures, type_, runnable, items, push_num, is_regression)
+                for type_, items in items_by_type
+            ]
+        else:
+            counts = passed_counts[runnable]
 
         (
-            total_components_failures,
-            past_700_pushes_components_failures,
-            past_1400_pushes_components_failures,
-            past_2800_pushes_components_failures,
-        ) = _read_and_update_past_failures(
-            past_failures,
-            "component",
-            runnable,
-            commit["components"],
-            push_num,
-            is_regression,
-        )
+            (
+                total_failures,
+                past_700_pushes_failures,
+                past_1400_pushes_failures,
+                past_2800_pushes_failures,
+            ),
+            (
+                total_types_failures,
+                past_700_pushes_types_failures,
+                past_1400_pushes_types_failures,
+                past_2800_pushes_types_failures,
+            ),
+            (
+                total_files_failures,
+                past_700_pushes_files_failures,
+                past_1400_pushes_files_failures,
+                past_2800_pushes_files_failures,
+            ),
+            (
+                total_directories_failures,
+                past_700_pushes_directories_failures,
+                past_1400_pushes_directories_failures,
+                past_2800_pushes_directories_failures,
+            ),
+            (
+                total_components_failures,
+                past_700_pushes_components_failures,
+                past_1400_pushes_components_failures,
+                past_2800_pushes_components_failures,
+            ),
+        ) = counts
 
         obj = {
             "name": runnable,
@@ -324,76 +695,233 @@ def generate_data(
         yield obj
 
 
-def generate_history(filename, limit=None):
-    commits = get_pushes(filename, limit)
-    generate_failing_together_probabilities("label", commits)
+def _generate_push_data(past_failures: PastFailures, commit: dict, push_num: int):
+    # XXX: For now, skip commits which are too large.
+    # In the future we can either:
+    #  - Improve shelve perf and go back to consider all files;
+    #  - Consider only files which appear with a given frequency, like the "files" feature in commit_features;
+    #  - Keep a limit of number of files.
+    if len(commit["files"]) > 50:
+        return None
 
-    def generate_all_data() -> Generator[dict[str, Any], None, None]:
-        # global past_failures
-        past_failures = {}
+    # If we considered all_runnables, we'd generate a huge amount of data.
+    # We consider only the runnables which run in this push, and the possible and likely regressions
+    # from this push. We can't consider all runnables because we can't be sure that a task that didn't
+    # run on a push would have been successful.
+    runnables_to_consider = ALL_TESTS
 
-        push_num = 0
+    # Sync DB every 250 pushes, so we cleanup the shelve cache (we'd run OOM otherwise!).
+    # if i % 250 == 0:
+    #     past_failures.sync()
 
-        # Store all runnables in the past_failures DB so it can be used in the evaluation phase.
-        past_failures["all_runnables"] = ALL_TESTS
-        # XXX: Should we recreate the DB from scratch if the previous all_runnables are not the
-        # same as the current ones?
+    result_data = []
+    for data in generate_data(
+            past_failures,
+            commit,
+            push_num,
+            runnables_to_consider,
+            commit['failures']
+    ):
+        result_data.append(data)
+
+    return {
+        "revs": [commit['node']],
+        "data": result_data,
+    }
+
+
+def _update_past_failures(past_failures: PastFailures, commit: dict, push_num: int) -> None:
+    """Apply the updates of _generate_push_data to past_failures, without generating any data."""
+    if len(commit["files"]) > 50:
+        return
+
+    for runnable in ALL_TESTS:
+        if runnable not in commit['failures']:
+            continue
+        for type_, items in (
+                ("all", ("all",)),
+                ("type", commit["types"]),
+                ("file", commit["files"]),
+                ("directory", commit["directories"]),
+                ("component", commit["components"]),
+        ):
+            _read_and_update_past_failures(past_failures, type_, runnable, items, push_num, True)
+
+
+def _get_shard_path(shard: int) -> str:
+    return TEST_SCHEDULING_SHARD_PATH.format(shard)
+
+
+def _remove_stale_shards(keep: set) -> None:
+    """Remove the shards from previous runs which aren't part of the index anymore."""
+    for path in glob.glob(TEST_SCHEDULING_SHARD_GLOB):
+        if path not in keep:
+            os.remove(path)
+
+
+def _generate_shard(shard: int, past_failures: bytes, push_num: int, commits: list) -> int:
+    past_failures = pickle.loads(past_failures)
+
+    def generate_shard_data() -> Generator[dict[str, Any], None, None]:
+        for i, commit in enumerate(commits):
+            push_data = _generate_push_data(past_failures, commit, push_num + i + 1)
+            if push_data is not None:
+                yield push_data
+
+    write(generate_shard_data(), _get_shard_path(shard))
+    return shard
+
+
+def get_test_scheduling_paths() -> list[str]:
+    """Get the files the test scheduling data is read from, whether it was generated in shards or not."""
+    if not os.path.exists(TEST_SCHEDULING_INDEX_PATH):
+        return [TEST_SCHEDULING_PATH]
+
+    index = next(read(TEST_SCHEDULING_INDEX_PATH))
+    return [TEST_SCHEDULING_INDEX_PATH] + [shard["path"] for shard in index["shards"]]
+
+
+def read_test_scheduling(parallel: bool = False) -> Generator[dict[str, Any], None, None]:
+    """Read the test scheduling data in push order, whether it was generated in shards or not.
+
+    Args:
+        parallel: decompress the next READ_PREFETCH_SHARDS shards in worker processes while the current one
+            is consumed. The records are still unpickled here, so that they aren't serialized twice; this only
+            helps when decompression is a significant part of the time and spare cores are available
+            (see `dataset/benchmark.py --test-scheduling`).
+    """
+    if not os.path.exists(TEST_SCHEDULING_INDEX_PATH):
+        yield from read(TEST_SCHEDULING_PATH)
+        return
+
+    index = next(read(TEST_SCHEDULING_INDEX_PATH))
+    paths = [shard["path"] for shard in index["shards"]]
+
+    if not parallel:
+        for path in paths:
+            yield from read(path)
+        return
+
+    # Only READ_PREFETCH_SHARDS shards are decompressed ahead, so memory doesn't grow with the number of shards.
+    paths = iter(paths)
+    with mp.Pool(READ_PREFETCH_SHARDS) as pool:
+        pending = deque(
+            (path, pool.apply_async(decompress, (path,))) for path in itertools.islice(paths, READ_PREFETCH_SHARDS)
+        )
+        while pending:
+            path, result = pending.popleft()
+            data = result.get()
+            for next_path in itertools.islice(paths, 1):
+                pending.append((next_path, pool.apply_async(decompress, (next_path,))))
+            yield from loads(data, path)
 
-        skipped_no_commits = 0
-        skipped_too_big_commits = 0
-        skipped_no_runnables = 0
 
-        for commit in tqdm(commits, 'processing commits'):
-            push_num += 1
+def generate_history(filename, limit=None, jobs=1, shard_size=5000):
+    """Generate the past failures, failing together and test scheduling DBs from commits.json.
 
-            # XXX: For now, skip commits which are too large.
-            # In the future we can either:
-            #  - Improve shelve perf and go back to consider all files;
-            #  - Consider only files which appear with a given frequency, like the "files" feature in commit_features;
-            #  - Keep a limit of number of files.
-            if len(commit["files"]) > 50:
-                skipped_too_big_commits += 1
-                continue
+    Args:
+        jobs: if greater than 1, generate the test scheduling data in shards of `shard_size` pushes
+            with `jobs` processes. Only the past failures updates are replayed sequentially, and
+            each shard starts from a copy of past_failures taken at its first push.
+    """
+    # Commits are streamed once, feeding both the failing together statistics and the past failures.
+    failing_together_stats = load_failing_together_stats()
+
+    # global past_failures
+    past_failures = PastFailures()
 
-            # If we considered all_runnables, we'd generate a huge amount of data.
-            # We consider only the runnables which run in this push, and the possible and likely regressions
-            # from this push. We can't consider all runnables because we can't be sure that a task that didn't
-            # run on a push would have been successful.
-            runnables_to_consider = ALL_TESTS
+    push_num = 0
 
-            # Sync DB every 250 pushes, so we cleanup the shelve cache (we'd run OOM otherwise!).
-            # if i % 250 == 0:
-            #     past_failures.sync()
+    # Store all runnables in the past_failures DB so it can be used in the evaluation phase.
+    past_failures["all_runnables"] = ALL_TESTS
+    # XXX: Should we recreate the DB from scratch if the previous all_runnables are not the
+    # same as the current ones?
 
-            result_data = []
-            for data in generate_data(
-                    past_failures,
-                    commit,
-                    push_num,
-                    runnables_to_consider,
-                    commit['failures']
-            ):
-                result_data.append(data)
+    skipped_no_commits = 0
+    skipped_too_big_commits = 0
+    skipped_no_runnables = 0
+    failing_together_changed = False
 
-            yield {
-                "revs": [commit['node']],
-                "data": result_data,
-            }
+    def process_commits() -> Generator[tuple[dict, int], None, None]:
+        nonlocal push_num, skipped_too_big_commits, failing_together_changed
 
-        logger.info("saved push data nodes: %d", len(commits))
-        logger.info("skipped %d (no commits in our DB)", skipped_no_commits)
-        logger.info("skipped %d (too big commits)", skipped_too_big_commits)
-        logger.info("skipped %d (no interesting runnables)", skipped_no_runnables)
+        for commit in tqdm(iter_pushes(filename, limit, SHARD_COMMIT_FIELDS), 'processing commits'):
+            failing_together_changed |= failing_together_stats.feed(push_num, commit)
+            push_num += 1
 
-        past_failures["push_num"] = push_num
-        write([past_failures], 'data/past_failures.pickle.zstd')
+            if len(commit["files"]) > 50:
+                skipped_too_big_commits += 1
 
-    write(generate_all_data(), 'data/test_scheduling.pickle.zstd')
+            yield commit, push_num
+
+    if jobs > 1:
+        shards = []
+        results = []
+        shard_commits = []
+        shard_past_failures = pickle.dumps(past_failures)
+
+        with mp.Pool(jobs) as pool:
+            def submit_shard() -> None:
+                start = push_num - len(shard_commits)
+                shards.append({"path": _get_shard_path(len(shards)), "start": start, "end": push_num})
+                # Don't let the sequential pass get too far ahead of the workers.
+                if len(results) >= 2 * jobs:
+                    results[len(results) - 2 * jobs].get()
+                results.append(pool.apply_async(
+                    _generate_shard, (len(shards) - 1, shard_past_failures, start, shard_commits)
+                ))
+
+            for commit, commit_push_num in process_commits():
+                # Workers only need the fields used by _generate_push_data.
+                shard_commits.append({key: commit[key] for key in SHARD_COMMIT_FIELDS})
+                _update_past_failures(past_failures, commit, commit_push_num)
+
+                if len(shard_commits) == shard_size:
+                    submit_shard()
+                    shard_commits = []
+                    shard_past_failures = pickle.dumps(past_failures)
+
+            if len(shard_commits) > 0:
+                submit_shard()
+
+            for result in tqdm(results, 'generating shards'):
+                result.get()
+
+        write([{"shards": shards}], TEST_SCHEDULING_INDEX_PATH)
+        _remove_stale_shards({shard["path"] for shard in shards})
+        if os.path.exists(TEST_SCHEDULING_PATH):
+            os.remove(TEST_SCHEDULING_PATH)
+    else:
+        def generate_all_data() -> Generator[dict[str, Any], None, None]:
+            for commit, commit_push_num in process_commits():
+                push_data = _generate_push_data(past_failures, commit, commit_push_num)
+                if push_data is not None:
+                    yield push_data
+
+        write(generate_all_data(), TEST_SCHEDULING_PATH)
+
+        if os.path.exists(TEST_SCHEDULING_INDEX_PATH):
+            os.remove(TEST_SCHEDULING_INDEX_PATH)
+        _remove_stale_shards(set())
+
+    logger.info("saved push data nodes: %d", push_num)
+    logger.info("skipped %d (no commits in our DB)", skipped_no_commits)
+    logger.info("skipped %d (too big commits)", skipped_too_big_commits)
+    logger.info("skipped %d (no interesting runnables)", skipped_no_runnables)
+
+    past_failures["push_num"] = push_num
+    write([past_failures.to_dict()], PAST_FAILURES_PATH)
+
+    if failing_together_changed or not os.path.exists(FAILING_TOGETHER_STATS_PATH):
+        write([failing_together_stats.to_dict()], FAILING_TOGETHER_STATS_PATH)
+    write_failing_together_probabilities("label", failing_together_stats, push_num)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract features of unit tests')
     parser.add_argument("--path", type=str, default='data/commits.json', help="Path to commit features")
     parser.add_argument("--limit", type=int, default=None, help="Limit of the number of pushes")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes generating test scheduling shards")
+    parser.add_argument("--shard-size", type=int, default=5000, help="Number of pushes in each test scheduling shard")
     args = parser.parse_args()
-    generate_history(args.path, args.limit)
+    generate_history(args.path, args.limit, args.jobs, args.shard_size)
@@ -1,6 +1,5 @@
 # Created by Baole Fang at 8/3/23
 
-import pickle
 from imblearn.metrics import classification_report_imbalanced
 from sklearn import metrics
 from tabulate import tabulate
@@ -8,6 +7,8 @@ from dash import Dash, dcc, html, Input, Output
 import dash_mantine_components as dmc
 import plotly.graph_objects as go
 
+from utils import load_matrix
+
 
 def print_labeled_confusion_matrix(confusion_matrix, labels, is_multilabel=False):
     confusion_matrix_table = confusion_matrix.tolist()
@@ -40,12 +41,9 @@ def print_labeled_confusion_matrix(confusion_matrix, labels, is_multilabel=False
         )
 
 
-with open("testlabelselectmodel_data_y_pred", "rb") as f:
-    x = pickle.load(f)[:, 1].reshape(-1, 80)
-with open("testoverallmodel_data_y", "rb") as f:
-    y = pickle.load(f)
-with open("testoverallmodel_data_y_pred", "rb") as f:
-    yy = pickle.load(f)[:, 1]
+x = load_matrix("testlabelselectmodel_data_y_pred")[:, 1].reshape(-1, 80)
+y = load_matrix("testoverallmodel_data_y")
+yy = load_matrix("testoverallmodel_data_y_pred")[:, 1]
 
 app = Dash(__name__)
 
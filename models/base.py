@@ -3,12 +3,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import hashlib
 import logging
 import math
 import os
 import pickle
 from collections import defaultdict
-from typing import Any
+from typing import Any, Optional
 
 import matplotlib
 import numpy as np
@@ -29,7 +30,7 @@ from tabulate import tabulate
 
 from dataset import db
 from .nlp import SpacyVectorizer
-from utils import split_tuple_generator, to_array
+from utils import hash_files, load_matrix, save_matrix, split_tuple_generator, to_array
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -328,18 +329,28 @@ class Model:
         self.class_names = self.get_labels()
         self.class_names = sort_class_names(self.class_names)
 
-        # Get items and labels, filtering out those for which we have no labels.
-        X_gen, y = split_tuple_generator(lambda: self.items_gen(limit))
+        dataset_key = self.get_dataset_key(limit) if self.store_dataset else None
+        dataset = self.load_dataset(dataset_key) if dataset_key is not None else None
+        if dataset is not None:
+            logger.info("Inputs unchanged, using the features of the stored dataset")
+            X, y = dataset
+        else:
+            # Get items and labels, filtering out those for which we have no labels.
+            X_gen, y = split_tuple_generator(lambda: self.items_gen(limit))
+
+            # x = next(X_gen())
+            # print(x)
+
+            # Extract features from the items.
+            X = self.extraction_pipeline.fit_transform(X_gen)
+            print("finish reading X")
 
-        # x = next(X_gen())
-        # print(x)
+            # Calculate labels.
+            y = np.array(y)
 
-        # Extract features from the items.
-        X = self.extraction_pipeline.fit_transform(X_gen)
-        print("finish reading X")
+            if self.store_dataset:
+                self.save_dataset(dataset_key, X, y)
 
-        # Calculate labels.
-        y = np.array(y)
         self.le.fit(y)
 
         # if limit:
@@ -560,17 +571,75 @@ class Model:
             pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         if self.store_dataset:
-            with open(f"{self.__class__.__name__.lower()}_data_X", "wb") as f:
-                pickle.dump(X, f, protocol=pickle.HIGHEST_PROTOCOL)
+            save_matrix(self.get_dataset_path("y_pred"), self.clf.predict_proba(X))
 
-            with open(f"{self.__class__.__name__.lower()}_data_y", "wb") as f:
-                pickle.dump(y, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return tracking_metrics
 
-            y_pred=self.clf.predict_proba(X)
-            with open(f"{self.__class__.__name__.lower()}_data_y_pred", "wb") as f:
-                pickle.dump(y_pred, f, protocol=pickle.HIGHEST_PROTOCOL)
+    def get_dataset_path(self, name: str) -> str:
+        return f"{self.__class__.__name__.lower()}_data_{name}"
 
-        return tracking_metrics
+    def get_dataset_inputs(self) -> Optional[list[str]]:
+        """Get all the files items_gen reads, which subclasses must declare for their dataset to be reused.
+
+        Returns:
+            the paths, or None if they are unknown.
+        """
+        return None
+
+    def get_dataset_key(self, limit=None) -> Optional[str]:
+        """Hash what the features depend on: the input files, the unfitted extraction pipeline and the limit.
+
+        Returns:
+            the hash, or None if the inputs are unknown and the dataset can't be reused.
+        """
+        inputs = self.get_dataset_inputs()
+        if inputs is None:
+            return None
+
+        digest = hashlib.sha256()
+        digest.update(pickle.dumps((self.__class__.__name__, limit, self.class_names), protocol=4))
+        digest.update(pickle.dumps(self.extraction_pipeline, protocol=4))
+        return hash_files(inputs, digest).hexdigest()
+
+    def load_dataset(self, key: str):
+        """Load the memory-mapped X and y and the fitted extraction pipeline stored by `save_dataset`.
+
+        Returns:
+            (X, y), or None if no dataset was stored for `key`.
+        """
+        key_path = self.get_dataset_path("key")
+        if not os.path.exists(key_path):
+            return None
+        with open(key_path, "r") as f:
+            if f.read() != key:
+                return None
+
+        try:
+            with open(self.get_dataset_path("pipeline"), "rb") as f:
+                extraction_pipeline = pickle.load(f)
+            X = load_matrix(self.get_dataset_path("X"))
+            y = load_matrix(self.get_dataset_path("y"))
+        except (FileNotFoundError, ValueError, pickle.UnpicklingError) as e:
+            logger.warning("Failed to load the stored dataset: %s", e)
+            return None
+
+        self.extraction_pipeline = extraction_pipeline
+        return X, y
+
+    def save_dataset(self, key: Optional[str], X, y) -> None:
+        # The key is written last, so that a partially written dataset is never loaded.
+        key_path = self.get_dataset_path("key")
+        if os.path.exists(key_path):
+            os.remove(key_path)
+
+        save_matrix(self.get_dataset_path("X"), X)
+        save_matrix(self.get_dataset_path("y"), y)
+        with open(self.get_dataset_path("pipeline"), "wb") as f:
+            pickle.dump(self.extraction_pipeline, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if key is not None:
+            with open(key_path, "w") as f:
+                f.write(key)
 
     @staticmethod
     def load(model_file_name: str) -> "Model":
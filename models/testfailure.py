@@ -8,12 +8,10 @@ import logging
 import numpy as np
 import xgboost
 from imblearn.under_sampling import RandomUnderSampler
-from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline
 from tqdm import tqdm
 
-from dataset import commit_features, db
+from dataset import commit_features, db, test_history
 from .base import Model
 from . import register
 import utils
@@ -24,6 +22,9 @@ logger = logging.getLogger(__name__)
 
 @register('testfailure')
 class TestFailureModel(Model):
+    # Columns of the commits used by the feature extractors and the labels.
+    COMMIT_COLUMNS = commit_features.MERGE_COMMITS_COLUMNS + ("failures",)
+
     def __init__(self, lemmatization=False,path='data/commits.json',):
         Model.__init__(self, lemmatization,path)
 
@@ -60,9 +61,8 @@ class TestFailureModel(Model):
             [
                 (
                     "commit_extractor",
-                    commit_features.CommitExtractor(feature_extractors, []),
+                    commit_features.CommitVectorizer(feature_extractors, [], dtype=np.float32),
                 ),
-                ("union", ColumnTransformer([("data", DictVectorizer(dtype=np.float32), "data")])),
             ]
         )
 
@@ -70,12 +70,12 @@ class TestFailureModel(Model):
         self.clf.set_params(predictor="cpu_predictor")
 
     def items_gen(self, limit=None):
-        commit_map = utils.get_commit_map(path=self.commits_path)
+        commit_map = utils.get_commit_map(path=self.commits_path, columns=self.COMMIT_COLUMNS)
 
         assert len(commit_map) > 0
         i=0
 
-        for item in tqdm(db.read('data/test_scheduling.pickle.zstd'), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
+        for item in tqdm(test_history.read_test_scheduling(), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
             i += 1
             if limit and i > limit:
                 break
@@ -91,9 +91,12 @@ class TestFailureModel(Model):
             label=1 if any(commit['failures'] for commit in commits) else 0
             yield commit_data, label
 
+    def get_dataset_inputs(self):
+        return [self.commits_path] + test_history.get_test_scheduling_paths()
+
     def get_labels(self):
         classes = {}
-        for commit in db.read(self.commits_path):
+        for commit in db.read(self.commits_path, ("node", "failures")):
             if self.limit and len(classes) >= self.limit:
                 break
             classes[commit['node']]=1 if commit['failures'] else 0
@@ -109,4 +112,4 @@ class TestFailureModel(Model):
         return [0, 1]
 
     def get_feature_names(self):
-        return self.extraction_pipeline.named_steps["union"].get_feature_names_out()
+        return self.extraction_pipeline[-1].get_feature_names_out()
@@ -4,18 +4,15 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
-import pickle
 
 import numpy as np
 import xgboost
 from imblearn.under_sampling import RandomUnderSampler
-from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline
 from sklearn.neural_network import MLPClassifier
 from tqdm import tqdm
 
-from dataset import commit_features, db
+from dataset import commit_features, db, test_history
 from .base import Model
 from . import register
 import utils
@@ -63,9 +60,8 @@ class TestOverallModel(Model):
             [
                 (
                     "commit_extractor",
-                    commit_features.CommitExtractor(feature_extractors, []),
+                    commit_features.CommitVectorizer(feature_extractors, [], dtype=np.float32),
                 ),
-                ("union", ColumnTransformer([("data", DictVectorizer(dtype=np.float32), "data")])),
             ]
         )
 
@@ -74,15 +70,14 @@ class TestOverallModel(Model):
         self.clf.set_params(predictor="cpu_predictor")
 
     def items_gen(self, limit=None):
-        with open("testlabelselectmodel_data_y_pred", "rb") as f:
-            probability=pickle.load(f)[:,1].reshape(-1,len(list(db.read('data/tests.json'))))
+        probability=utils.load_matrix("testlabelselectmodel_data_y_pred")[:,1].reshape(-1,len(list(db.read('data/tests.json'))))
 
         commit_map = utils.get_commit_map(path=self.commits_path)
 
         assert len(commit_map) > 0
         i=0
 
-        for item in tqdm(db.read('data/test_scheduling.pickle.zstd'), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
+        for item in tqdm(test_history.read_test_scheduling(), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
             if limit and i > limit:
                 break
             revs, test_datas = item['revs'], item['data']
@@ -99,6 +94,11 @@ class TestOverallModel(Model):
             i += 1
             yield commit_data, label
 
+    def get_dataset_inputs(self):
+        return [self.commits_path] + test_history.get_test_scheduling_paths() + [
+            "testlabelselectmodel_data_y_pred.npy", "data/tests.json"
+        ]
+
     def get_labels(self):
         classes = {}
         for commit in db.read(self.commits_path):
@@ -117,4 +117,4 @@ class TestOverallModel(Model):
         return [0, 1]
 
     def get_feature_names(self):
-        return self.extraction_pipeline.named_steps["union"].get_feature_names_out()
+        return self.extraction_pipeline[-1].get_feature_names_out()
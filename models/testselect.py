@@ -18,8 +18,6 @@ import numpy as np
 import xgboost
 from imblearn.under_sampling import RandomUnderSampler
 from ortools.linear_solver import pywraplp
-from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline
 from tqdm import tqdm
 
@@ -256,9 +254,8 @@ class TestSelectModel(Model):
             [
                 (
                     "commit_extractor",
-                    commit_features.CommitExtractor(feature_extractors, []),
+                    commit_features.CommitVectorizer(feature_extractors, [], dtype=np.float32),
                 ),
-                ("union", ColumnTransformer([("data", DictVectorizer(dtype=np.float32), "data")])),
                 # ("union", ColumnTransformer([("data", DictVectorizer(sparse=True, dtype=np.float32), "data")],
                 #                             sparse_threshold=float('inf'), n_jobs=os.cpu_count())),
                 # ("converter", utils.Converter())
@@ -272,7 +269,7 @@ class TestSelectModel(Model):
             self, apply_filters: bool = False
     ) -> tuple[list[dict[str, Any]], int]:
         pushes = []
-        all_tests = next(db.read('data/past_failures.pickle.zstd'))['all_runnables']
+        all_tests = test_history.PAST_FAILURES.get()['all_runnables']
         for commit in db.read(self.commits_path):
             if self.limit and len(pushes) >= self.limit:
                 break
@@ -336,7 +333,7 @@ class TestSelectModel(Model):
     def items_gen(self, limit=None):
         commit_map = utils.get_commit_map(path=self.commits_path)
         i = 0
-        for item in tqdm(db.read('data/test_scheduling.pickle.zstd'), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
+        for item in tqdm(test_history.read_test_scheduling(), total=min(limit,len(commit_map)) if limit else len(commit_map), desc='generating data'):
             i += 1
             if limit and i > limit:
                 break
@@ -362,6 +359,9 @@ class TestSelectModel(Model):
                 commit_data["test_job"] = test_data
                 yield commit_data, label
 
+    def get_dataset_inputs(self):
+        return [self.commits_path] + test_history.get_test_scheduling_paths()
+
     # def items_gen(self, classes, limit=None):
     #     commit_map = get_commit_map()
     #     i=0
@@ -417,32 +417,58 @@ class TestSelectModel(Model):
             confidence: float = 0.5,
             push_num: Optional[int] = None,
     ) -> dict[str, float]:
-        commit_data = commit_features.merge_commits(commits)
-
-        past_failures_data = next(db.read('data/past_failures.pickle.zstd'))
+        return self.select_tests_batch([(commits, push_num)], confidence)[0]
 
-        if push_num is None:
-            push_num = past_failures_data["push_num"] + 1
+    def select_tests_batch(
+            self,
+            pushes: Sequence[tuple[Sequence[dict], Optional[int]]],
+            confidence: float = 0.5,
+    ) -> list[dict[str, float]]:
+        """Select tests for many pushes with a single prediction.
+
+        Args:
+            pushes: (commits, push_num) tuples, where push_num None means the push
+                after the last one in the past failures DB.
+            confidence: minimum failure probability of the selected tests.
+
+        Returns:
+            a {test: probability} dict for each push, in the same order.
+        """
+        past_failures_data = test_history.PAST_FAILURES.get()
         all_runnables = past_failures_data["all_runnables"]
 
-        commit_tests = []
-        for data in test_history.generate_data(
-                past_failures_data,
-                commit_data,
-                push_num,
-                all_runnables,
-                [],
-        ):
-            commit_test = commit_data.copy()
-            commit_test["test_job"] = data
-            commit_tests.append(commit_test)
-
-        probs = self.classify(commit_tests, probabilities=True)
-        selected_indexes = np.argwhere(probs[:, 1] >= confidence)[:, 0]
-        return {
-            commit_tests[i]["test_job"]["name"]: math.floor(probs[i, 1] * 100) / 100
-            for i in selected_indexes
-        }
+        push_datas = []
+        for commits, push_num in pushes:
+            if push_num is None:
+                push_num = past_failures_data["push_num"] + 1
+            push_datas.append((commit_features.merge_commits(commits), push_num))
+
+        if len(push_datas) == 0:
+            return []
+
+        # Rows are generated lazily, so that only the extracted features of all the
+        # (push, test) couples are kept in memory.
+        def commit_tests():
+            for commit_data, push_num in push_datas:
+                for data in test_history.generate_data(
+                        past_failures_data,
+                        commit_data,
+                        push_num,
+                        all_runnables,
+                        [],
+                ):
+                    yield dict(commit_data, test_job=data)
+
+        X = self.extraction_pipeline.transform(commit_tests)
+        probs = self.clf.predict_proba(X)[:, 1].reshape(len(push_datas), len(all_runnables))
+
+        return [
+            {
+                all_runnables[i]: math.floor(push_probs[i] * 100) / 100
+                for i in np.argwhere(push_probs >= confidence)[:, 0]
+            }
+            for push_probs in probs
+        ]
 
     def evaluation(self) -> None:
         # Get a test set of pushes on which to test the model.
@@ -452,10 +478,9 @@ class TestSelectModel(Model):
         # only failure data from the training pushes (otherwise, we'd leak training information into the test
         # set).
         logger.info("Generate failing together DB (restricted to training pushes)")
-        commits = test_history.get_pushes(self.commits_path)
         test_history.generate_failing_together_probabilities(
             "label" if self.granularity == "label" else "config_group",
-            commits,
+            test_history.iter_pushes(self.commits_path, columns=("node", "failures")),
             pushes[train_push_len - 1]["revs"][0],
         )
 
@@ -489,11 +514,12 @@ class TestSelectModel(Model):
 
         commit_map = utils.get_commit_map(all_revs, path=self.commits_path)
 
-        past_failures_data = next(db.read('data/past_failures.pickle.zstd'))
+        past_failures_data = test_history.PAST_FAILURES.get()
         last_push_num = past_failures_data["push_num"]
 
         # Select tests for all the pushes in the test set.
-        for i, push in enumerate(tqdm(test_pushes.values(), desc='selecting tests')):
+        selected_pushes = []
+        for i, push in enumerate(test_pushes.values()):
             commits = tuple(
                 commit_map.pop(revision)
                 for revision in push["revs"]
@@ -509,9 +535,14 @@ class TestSelectModel(Model):
             # past failure data for the push itself.
             # The number 100 comes from the fact that in the past failure data
             # generation we store past failures in batches of 100 pushes.
-            push["all_possibly_selected"] = self.select_tests(
-                commits, 0.25, push_num
-            )
+            selected_pushes.append((push, commits, push_num))
+
+        logger.info("Selecting tests for %d pushes", len(selected_pushes))
+        all_possibly_selected = self.select_tests_batch(
+            [(commits, push_num) for _, commits, push_num in selected_pushes], 0.25
+        )
+        for (push, _, _), selected in zip(selected_pushes, all_possibly_selected):
+            push["all_possibly_selected"] = selected
 
         def do_eval(
                 executor: concurrent.futures.ProcessPoolExecutor,
@@ -689,7 +720,7 @@ class TestSelectModel(Model):
                     do_eval(executor, confidence_threshold, reduction, cap, minimum)
 
     def get_feature_names(self):
-        return self.extraction_pipeline.named_steps["union"].get_feature_names_out()
+        return self.extraction_pipeline[-1].get_feature_names_out()
 
 
 @register('testlabelselect')
@@ -0,0 +1,3 @@
+#!/bin/bash
+cd ~/libreoffice-ci || exit
+python client.py --path $1 --csv $1 --id $2 --url ${3:-http://127.0.0.1:8000}
@@ -0,0 +1,8 @@
+#!/bin/bash
+source ~/miniconda3/etc/profile.d/conda.sh
+conda activate libreoffice-ci
+
+cd ~/libreoffice-ci || exit
+export PYTHONPATH=${PYTHONPATH}:${pwd}
+export PATH=~/.cargo/bin:${PATH}
+python -W "ignore" test.py testlabelselect --path $1 --serve --port ${2:-8000} --output-root ${3:-~}
@@ -1,9 +1,15 @@
 # Created by Baole Fang at 6/30/23
 import argparse
+import json
 import os.path
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from logging import getLogger
 
 from dataset import rust_code_analysis_server
+from dataset.metrics_cache import METRICS_CACHE_DIR, MetricsCache
+from dataset.experiences import EXPERIENCES_PATH, calculate_experiences, load_experiences
+from dataset.git_fetch import FetchManager
 from models.testselect import TestLabelSelectModel
 from models.testoverall import TestOverallModel
 from git import Repo
@@ -14,6 +20,9 @@ import numpy as np
 
 logger = getLogger(__name__)
 
+# Number of repositories of requests kept open by the classification server.
+REPO_CACHE_SIZE = 4
+
 
 class CommitClassifier:
     def __init__(
@@ -24,7 +33,9 @@ class CommitClassifier:
             skip_feature_importance: bool,
             confidence_threshold: float,
             failure_threshold: float,
-            count_threshold: int
+            count_threshold: int,
+            metrics_cache: str = METRICS_CACHE_DIR,
+            experiences_path: str = EXPERIENCES_PATH
     ):
         self.model_name = model_name
         self.use_single_process = use_single_process
@@ -32,30 +43,58 @@ class CommitClassifier:
         self.testoverall_model = TestOverallModel.load('testoverallmodel')
         self.model: TestLabelSelectModel = TestLabelSelectModel.load(model_name)
         self.repo = Repo(repo_dir)
+        # Repositories of the requests, by path, the least recently used first.
+        self.repos = OrderedDict()
         self.confidence_threshold = confidence_threshold
         self.failure_threshold = failure_threshold
         self.count_threshold = count_threshold
-        self.code_analysis_server = rust_code_analysis_server.RustCodeAnalysisServer()
+        self.code_analysis_server = rust_code_analysis_server.RustCodeAnalysisServer(
+            cache=MetricsCache(metrics_cache) if metrics_cache else None
+        )
+        # Experiences of the mined history, updated in memory only for the commit being classified.
+        self.experiences = None
+        if os.path.exists(experiences_path):
+            self.experiences, self.first_pushdate = load_experiences(experiences_path, save=False)
+
+    def get_repo(self, repo_dir=None):
+        if repo_dir is None:
+            return self.repo
+        repo_dir = os.path.abspath(os.path.expanduser(repo_dir))
+        if repo_dir in self.repos:
+            self.repos.move_to_end(repo_dir)
+        else:
+            # Keep only a few repositories open, as requests can come from many workspaces.
+            if len(self.repos) >= REPO_CACHE_SIZE:
+                _, repo = self.repos.popitem(last=False)
+                repo.close()
+            self.repos[repo_dir] = Repo(repo_dir)
+        return self.repos[repo_dir]
 
-    def get_commit(self, revision):
+    def get_commit(self, revision, repo_dir=None):
+        repo = self.get_repo(repo_dir)
         if revision:
             try:
-                c = self.repo.commit(revision)
+                c = repo.commit(revision)
             except:
-                self.repo.remotes[0].fetch(revision)
-                c = self.repo.commit(revision)
+                FetchManager(repo.working_dir).fetch([revision])
+                c = repo.commit(revision)
             finally:
-                commit = Commit(c)
-                commit.transform(c, self.code_analysis_server)
-                return commit.to_dict()
+                return self.transform(c)
         else:
-            c = self.repo.head.commit
-            commit = Commit(c)
-            commit.transform(c, self.code_analysis_server)
-            return commit.to_dict()
+            c = repo.head.commit
+            return self.transform(c)
+
+    def transform(self, c) -> dict:
+        commit = Commit(c)
+        commit.transform(c, self.code_analysis_server)
+        if self.experiences is not None:
+            self.experiences.reset()
+            calculate_experiences([commit], self.first_pushdate, save=False, experiences=self.experiences)
+        return commit.to_dict()
 
-    def classify(self, revision: str, save: bool, csv_path: str, id: str):
-        commit = self.get_commit(revision)
+    def classify(self, revision: str, save: bool, csv_path: str, id: str, save_path: str = './',
+                 repo_dir: str = None) -> int:
+        commit = self.get_commit(revision, repo_dir)
 
         selected_tasks = self.model.select_tests([commit], -1)
         selected_tasks = dict(sorted(selected_tasks.items()))
@@ -77,23 +116,109 @@ class CommitClassifier:
             writer.writerows(selected_tasks.items())
 
         if save:
-            with open("failure_risk", "w") as f:
+            with open(os.path.join(save_path, "failure_risk"), "w") as f:
                 f.write(
                     "1"
                     if testfailure_probs[0][1]
                        > self.confidence_threshold
                     else "0"
                 )
-            with open("selected_tasks", "w") as f:
+            with open(os.path.join(save_path, "selected_tasks"), "w") as f:
                 f.writelines(
                     f"{selected_task}: {prob}\n" for selected_task, prob in selected_tasks.items()
                 )
 
         if testfailure_probs[0][1] > self.failure_threshold or \
                 (probability > self.confidence_threshold).sum() >= self.count_threshold:
-            exit(1)
+            return 1
+        else:
+            return 0
+
+    def terminate(self):
+        self.code_analysis_server.terminate()
+
+
+class ClassifierRequestHandler(BaseHTTPRequestHandler):
+    """Serve classification requests with models and code analysis server kept warm.
+
+    Requests are handled one at a time, as neither the models nor the code
+    analysis server are safe to share between threads. The csv and save paths
+    of requests are resolved under `output_root`, and requests writing outside
+    of it are rejected.
+    """
+    classifier: CommitClassifier = None
+    output_root: str = "."
+
+    def resolve_path(self, path) -> str:
+        """Resolve a path of a request relative to the output root, raising ValueError if it is outside."""
+        if not isinstance(path, str):
+            raise ValueError(f"{path!r} is not a path")
+        root = os.path.realpath(self.output_root)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ValueError(f"{path} is outside of {root}")
+        return resolved
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/ping":
+            self.send_json(200, {"ok": True})
         else:
-            exit(0)
+            self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self.send_json(404, {"error": f"unknown endpoint {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            csv_path = self.resolve_path(request.get("csv", "./"))
+            save_path = self.resolve_path(request.get("save_path", "./"))
+        except ValueError as e:
+            self.send_json(400, {"error": f"invalid request: {e}"})
+            return
+
+        try:
+            returncode = self.classifier.classify(
+                request.get("revision"),
+                request.get("save", False),
+                csv_path,
+                request.get("id", ""),
+                save_path,
+                request.get("path"),
+            )
+        except Exception as e:
+            logger.exception("Failed to classify %s", request.get("revision"))
+            self.send_json(500, {"error": str(e)})
+            return
+
+        self.send_json(200, {"returncode": returncode})
+
+
+def serve(classifier: CommitClassifier, host: str, port: int, output_root: str = ".") -> None:
+    ClassifierRequestHandler.classifier = classifier
+    ClassifierRequestHandler.output_root = os.path.realpath(os.path.expanduser(output_root))
+    server = HTTPServer((host, port), ClassifierRequestHandler)
+    logger.info("Serving classification requests at http://%s:%d, writing results under %s", host, port,
+                ClassifierRequestHandler.output_root)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        classifier.terminate()
 
 
 def main() -> None:
@@ -149,6 +274,31 @@ def main() -> None:
         help="Patch with more than or equal to count_threshold failed unit tests are considered failed."
     )
     parser.add_argument("--save", action="store_true", help="Whether to write results to file.")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Keep models loaded and serve classification requests over HTTP instead of classifying once.",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to serve requests on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to serve requests on.")
+    parser.add_argument(
+        "--output-root",
+        type=str,
+        default=".",
+        help="Directory under which served requests may write their csv and results.",
+    )
+    parser.add_argument(
+        "--metrics-cache",
+        type=str,
+        default=METRICS_CACHE_DIR,
+        help="Directory of the code metrics cache, empty to disable it.",
+    )
+    parser.add_argument(
+        "--experiences",
+        type=str,
+        default=EXPERIENCES_PATH,
+        help="Path of the experiences saved by mining, used to compute experience features.",
+    )
 
     args = parser.parse_args()
 
@@ -162,9 +312,17 @@ def main() -> None:
         args.skip_feature_importance,
         args.confidence_threshold,
         args.failure_threshold,
-        args.count_threshold
+        args.count_threshold,
+        args.metrics_cache,
+        args.experiences
     )
-    classifier.classify(args.revision, args.save, args.csv, args.id)
+    if args.serve:
+        serve(classifier, args.host, args.port, args.output_root)
+        return
+
+    returncode = classifier.classify(args.revision, args.save, args.csv, args.id)
+    classifier.terminate()
+    exit(returncode)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dataset.db import write  # noqa: E402
+
+# Some modules read data/tests.json when they are imported, so all the tests share the same list.
+TESTS = ["CppunitTest_a", "CppunitTest_b", "CppunitTest_c"]
+
+
+def _import_models():
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, "data"))
+        write(TESTS, os.path.join(directory, "data", "tests.json"))
+        os.chdir(directory)
+        try:
+            import dataset.test_history  # noqa: F401
+            import models  # noqa: F401
+        finally:
+            os.chdir(cwd)
+
+
+_import_models()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Run the test in a directory with a `data` directory, like the root of the repository."""
+    os.makedirs(tmp_path / "data")
+    write(TESTS, str(tmp_path / "data" / "tests.json"))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
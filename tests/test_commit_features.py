@@ -0,0 +1,59 @@
+import numpy as np
+import scipy.sparse
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction import DictVectorizer
+from sklearn.pipeline import Pipeline
+
+from dataset import commit_features
+
+
+class repeated_types(object):
+    name = "repeated types"
+
+    def __call__(self, commit, **kwargs):
+        return {"types": commit["types"], "author": commit["author"]}
+
+
+class repeated_files(object):
+    name = "files"
+
+    def __call__(self, commit, **kwargs):
+        return commit["files"]
+
+
+class lines(object):
+    def __call__(self, commit, **kwargs):
+        return commit["lines"]
+
+
+COMMITS = [
+    {"types": ["C++", "C++", "Java"], "author": "a", "files": ["x", "x"], "lines": 3},
+    {"types": [], "author": "b", "files": ["y"], "lines": None},
+    {"types": ["Java", "Python", "Java", "Java"], "author": "a", "files": [], "lines": 0},
+]
+
+
+def to_dense(X):
+    return X.toarray() if scipy.sparse.issparse(X) else X
+
+
+def test_commit_vectorizer():
+    feature_extractors = [repeated_types(), repeated_files(), lines()]
+    vectorizer = commit_features.CommitVectorizer(feature_extractors, [], sparse_threshold=1.0)
+    X = vectorizer.fit_transform(lambda: iter(COMMITS))
+
+    pipeline = Pipeline([
+        ("commit_extractor", commit_features.CommitExtractor(feature_extractors, [])),
+        ("union", ColumnTransformer([("data", DictVectorizer(dtype=np.float32), "data")])),
+    ])
+    expected = pipeline.fit_transform(lambda: iter(COMMITS))
+
+    assert list(vectorizer.get_feature_names_out()) == list(pipeline[-1].get_feature_names_out())
+    assert np.array_equal(to_dense(X), to_dense(expected), equal_nan=True)
+    assert np.array_equal(
+        to_dense(vectorizer.transform(lambda: iter(COMMITS))),
+        to_dense(pipeline.transform(lambda: iter(COMMITS))),
+        equal_nan=True,
+    )
+    # Repeated strings of an iterable are counted.
+    assert X[0, vectorizer.vocabulary_["types=C++"]] == 2
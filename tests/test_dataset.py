@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import scipy.sparse
+from sklearn.feature_extraction import DictVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+import utils
+from dataset import test_history
+from models.base import Model
+from models.testfailure import TestFailureModel
+from models.testoverall import TestOverallModel
+from models.testselect import TestLabelSelectModel
+
+
+def test_save_matrix(tmp_path):
+    dense = np.arange(12, dtype=np.float32).reshape(4, 3)
+    utils.save_matrix(str(tmp_path / "dense"), dense)
+    loaded = utils.load_matrix(str(tmp_path / "dense"))
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, dense)
+
+    sparse = scipy.sparse.random(50, 20, density=0.1, format="csr", dtype=np.float32, random_state=0)
+    utils.save_matrix(str(tmp_path / "sparse"), sparse)
+    loaded = utils.load_matrix(str(tmp_path / "sparse"))
+    assert (loaded != sparse).nnz == 0
+    assert not loaded.data.flags.writeable
+
+    # Overwriting a sparse matrix with a dense one.
+    utils.save_matrix(str(tmp_path / "sparse"), dense)
+    assert np.array_equal(utils.load_matrix(str(tmp_path / "sparse")), dense)
+
+
+def generate_items(items):
+    # Like CommitVectorizer, training gets a function generating the items.
+    return list(items() if callable(items) else items)
+
+
+class DatasetModel(Model):
+    inputs = None
+
+    def __init__(self):
+        Model.__init__(self, path="data/commits.json")
+        self.calculate_importance = False
+        self.cross_validation_enabled = False
+        self.extraction_pipeline = Pipeline(
+            [("items", FunctionTransformer(generate_items)), ("vectorizer", DictVectorizer())]
+        )
+        self.clf = LogisticRegression()
+        self.items_gen_calls = 0
+
+    def get_labels(self):
+        return [0, 1]
+
+    def items_gen(self, limit=None):
+        self.items_gen_calls += 1
+        with open("data/commits.json") as f:
+            offset = len(f.read())
+        for i in range(limit or 100):
+            yield {"a": float(i % 7 + offset), "b": float(i % 3)}, i % 2
+
+    def get_dataset_inputs(self):
+        return self.inputs
+
+
+class DeclaredDatasetModel(DatasetModel):
+    inputs = ["data/commits.json"]
+
+
+@pytest.mark.parametrize("declared", [True, False])
+def test_dataset_reuse(data_dir, declared):
+    with open("data/commits.json", "w") as f:
+        f.write("a")
+
+    model_class = DeclaredDatasetModel if declared else DatasetModel
+    for limit, changed, reused in ((None, False, False), (None, False, True), (50, False, False), (50, True, False)):
+        if changed:
+            with open("data/commits.json", "w") as f:
+                f.write("ab")
+
+        model = model_class()
+        model.train(limit=limit)
+        assert model.items_gen_calls == (0 if reused and declared else 1)
+
+        # The fitted pipeline is stored with the features.
+        X = utils.load_matrix(model.get_dataset_path("X"))
+        assert X.shape[0] == (limit or 100)
+        assert model.extraction_pipeline.transform([{"a": 1.0, "b": 1.0}]).shape[1] == X.shape[1]
+        assert utils.load_matrix(model.get_dataset_path("y_pred")).shape == (limit or 100, 2)
+
+
+def test_dataset_inputs(data_dir):
+    for model_class in (TestFailureModel, TestOverallModel, TestLabelSelectModel):
+        inputs = model_class(path="data/commits.json").get_dataset_inputs()
+        assert "data/commits.json" in inputs
+        assert test_history.TEST_SCHEDULING_PATH in inputs
@@ -0,0 +1,116 @@
+import pickle
+
+import numpy as np
+import pytest
+import zstandard
+
+from dataset import db
+
+
+def get_records(start, stop):
+    return [{"node": f"{i:040x}", "failures": ["CppunitTest_a"] if i % 3 == 0 else [], "count": i}
+            for i in range(start, stop)]
+
+
+def test_block(tmp_path):
+    path = str(tmp_path / "commits.block")
+    records = get_records(0, 10)
+    store = db.BlockStore(path, "wb", block_size=3)
+    store.write(iter(records))
+    store.close()
+
+    assert list(db.read(path)) == records
+    assert list(db.read(path, ("node",))) == [{"node": record["node"]} for record in records]
+    with db.db_open(path, "rb") as store:
+        assert len(store) == 10
+        assert store.index["starts"] == [0, 3, 6, 9]
+        assert list(store.keys()) == [record["node"] for record in records]
+        assert store.get(records[4]["node"]) == records[4]
+        with pytest.raises(KeyError):
+            store.get("missing")
+
+        # Keys are looked up in any order, repeated or missing.
+        keys = [records[9]["node"], "missing", records[0]["node"], records[5]["node"], records[0]["node"]]
+        assert store.get_many(keys) == {key: records[int(key, 16)] for key in keys if key != "missing"}
+        assert store.get_many([]) == {}
+
+        # Ranges within a block, across blocks, and past the end.
+        for start, stop in [(0, None), (1, 2), (2, 7), (3, 6), (8, 100), (5, 5), (7, 3), (10, None)]:
+            assert list(store.range(start, stop)) == records[start:stop]
+
+
+def test_block_append(tmp_path):
+    path = str(tmp_path / "commits.block")
+    records = get_records(0, 300)
+    db.write(records[:100], path)
+    db.append(iter(records[100:200]), path)
+    db.append(iter(records[200:]), path)
+
+    assert list(db.read(path)) == records
+    with db.db_open(path, "rb") as store:
+        assert store.index["starts"] == [0, 100, 200]
+        assert store.get_many([records[250]["node"], records[50]["node"]]) == {
+            records[250]["node"]: records[250], records[50]["node"]: records[50]
+        }
+
+    # Appending to a missing store creates it.
+    path = str(tmp_path / "new.block")
+    db.append(records[:10], path)
+    assert list(db.read(path)) == records[:10]
+
+
+def test_pickle(tmp_path):
+    path = str(tmp_path / "test_scheduling.pickle.zstd")
+    # Large records get smaller batches, and NumPy arrays are written as out-of-band buffers.
+    records = get_records(0, 100) + [{"node": "large", "count": -1, "data": np.arange(100000)}] + get_records(100, 3000)
+    db.write(iter(records), path)
+    db.append(iter(get_records(3000, 3010)), path)
+
+    read = list(db.read(path))
+    assert read[:100] + read[101:] == get_records(0, 3010)
+    assert np.array_equal(read[100]["data"], records[100]["data"])
+    assert list(db.read(path, ("count",)))[-1] == {"count": 3009}
+
+
+def test_pickle_legacy(tmp_path):
+    path = str(tmp_path / "test_scheduling.pickle.zstd")
+    records = get_records(0, 10)
+    # Files written before batches have a pickle per record.
+    with open(path, "wb") as f:
+        with zstandard.ZstdCompressor().stream_writer(f) as writer:
+            for record in records:
+                pickle.dump(record, writer)
+
+    assert list(db.read(path)) == records
+    db.append(iter(get_records(10, 20)), path)
+    assert list(db.read(path)) == get_records(0, 20)
+
+
+def test_parquet(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(db, "ROW_GROUP_SIZE", 2)
+    path = str(tmp_path / "commits.parquet")
+    records = [
+        {"node": "a", "failures": [], "metrics": {"sum": 1}, "author": None, "count": 1},
+        {"node": "b", "failures": [], "metrics": {"sum": 2}, "author": None, "count": 2},
+        # The types of some columns are only known after the first row group.
+        {"node": "c", "failures": ["CppunitTest_a"], "metrics": {"sum": 3, "max": 2}, "author": "x", "count": 3},
+        {"node": "d", "failures": ["CppunitTest_b"], "metrics": {}, "author": {"name": "y"}},
+    ]
+    db.write(iter(records), path)
+
+    assert list(db.read(path)) == [{"count": None, **record} for record in records]
+    assert list(db.read(path, ("node", "metrics"))) == [
+        {"node": record["node"], "metrics": record["metrics"]} for record in records
+    ]
+    # The records aren't modified.
+    assert records[0]["metrics"] == {"sum": 1}
+
+
+def test_parquet_mismatch(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setattr(db, "ROW_GROUP_SIZE", 1)
+    with pytest.raises(ValueError):
+        db.write([{"node": "a", "count": 1}, {"node": "b", "count": 1.5}], str(tmp_path / "commits.parquet"))
+    with pytest.raises(ValueError):
+        db.write([{"node": "a"}, {"node": "b", "count": 1}], str(tmp_path / "commits.parquet"))
@@ -0,0 +1,119 @@
+import copy
+import pickle
+import random
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from dataset import experiences
+from dataset.commit import Commit, get_directories
+
+
+class FakeCommit:
+    """The attributes of a Commit used by calculate_experiences."""
+
+    set_experience = Commit.set_experience
+
+    def __init__(self, i, pushdate, author, files):
+        self.node = f"{i:040x}"
+        self.pushdate = pushdate
+        self.author = author
+        self.reviewers = [f"reviewer{i % 3}"]
+        self.files = files
+        self.directories = get_directories(files)
+        self.file_copies = {}
+        self.ignored = i % 17 == 0
+        self.bug_id = None if i % 13 == 0 else i
+
+
+def get_commits(count):
+    rnd = random.Random(0)
+    files = [f"sw/source/dir{i % 4}/file{i}.cxx" for i in range(12)]
+    pushdate = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    commits = []
+    for i in range(count):
+        pushdate += timedelta(days=rnd.choice([0, 0, 1, 2, 30]), seconds=1)
+        commits.append(FakeCommit(i, pushdate, f"author{i % 5}", rnd.sample(files, rnd.randint(1, 4))))
+    return commits
+
+
+def features(commits):
+    return [commit.__dict__ for commit in commits]
+
+
+def set_experiences(commits, first_pushdate):
+    """Compute the file and directory experiences like before commit ids: queues of the tuples of previous
+    commits, counted with sets."""
+    queues = {}
+    expected = []
+    for commit in commits:
+        # Ignored commits don't get experiences.
+        if commit.ignored or commit.bug_id is None:
+            expected.append({})
+            continue
+
+        day = (commit.pushdate - first_pushdate).days
+        values = {}
+        for exp_type, items in (("file", commit.files), ("directory", commit.directories)):
+            item_queues = [
+                queues.setdefault((exp_type, item), experiences.ExpQueue(day, experiences.EXPERIENCE_TIMESPAN + 1, ()))
+                for item in items
+            ]
+            all_commit_lists = [queue[day] for queue in item_queues]
+            timespan_commit_lists = [
+                commit_list[len(queue[day - experiences.EXPERIENCE_TIMESPAN]):]
+                for commit_list, queue in zip(all_commit_lists, item_queues)
+            ]
+            for timespan, commit_lists in (("total", all_commit_lists),
+                                           (experiences.EXPERIENCE_TIMESPAN_TEXT, timespan_commit_lists)):
+                prefix = f"touched_prev_{timespan}_{exp_type}_"
+                values[f"{prefix}sum"] = len(set(sum(commit_lists, ())))
+                values[f"{prefix}max"] = max(len(commit_list) for commit_list in commit_lists)
+                values[f"{prefix}min"] = min(len(commit_list) for commit_list in commit_lists)
+            for commit_list, queue in zip(all_commit_lists, item_queues):
+                queue[day] = commit_list + (commit.node,)
+        expected.append(values)
+    return expected
+
+
+def test_count_distinct():
+    rnd = random.Random(0)
+    for sizes in [(), (0, 3), (5,), (3, 4, 5), (200, 100, 50)]:
+        commit_lists = [array("I", sorted(rnd.sample(range(400), size))) for size in sizes]
+        assert experiences.count_distinct(commit_lists) == len(set().union(*commit_lists))
+
+
+def test_calculate_experiences():
+    commits = get_commits(300)
+    experiences.calculate_experiences(commits, commits[0].pushdate)
+
+    expected = set_experiences(commits, commits[0].pushdate)
+    for commit, values in zip(commits, expected):
+        assert {key: getattr(commit, key) for key in values} == values
+    # The directories have enough commits for the counts to be merged with numpy.
+    assert max(getattr(commit, "touched_prev_total_directory_sum", 0) for commit in commits) >= 256
+
+
+def test_resume_experiences(tmp_path):
+    path = str(tmp_path / "experiences.pickle.zstd")
+    commits = get_commits(300)
+    first_pushdate = commits[0].pushdate
+    uninterrupted = copy.deepcopy(commits)
+    experiences.calculate_experiences(uninterrupted, first_pushdate)
+
+    first, second = copy.deepcopy(commits[:200]), copy.deepcopy(commits[200:])
+    saved = experiences.calculate_experiences(first, first_pushdate)
+    experiences.save_experiences(saved, first_pushdate, path)
+    loaded, loaded_pushdate = experiences.load_experiences(path)
+    assert loaded_pushdate == first_pushdate
+    experiences.calculate_experiences(second, loaded_pushdate, experiences=loaded)
+    assert features(first + second) == features(uninterrupted)
+
+    # Inference keeps its updates in memory: the same commits get the same features each time.
+    in_memory, _ = experiences.load_experiences(path, save=False)
+    state = pickle.dumps((in_memory.db_experiences, in_memory.last_day, in_memory.commit_count))
+    for _ in range(2):
+        inferred = copy.deepcopy(commits[200:210])
+        in_memory.reset()
+        experiences.calculate_experiences(inferred, first_pushdate, save=False, experiences=in_memory)
+        assert features(inferred) == features(uninterrupted[200:210])
+        assert pickle.dumps((in_memory.db_experiences, in_memory.last_day, in_memory.commit_count)) == state
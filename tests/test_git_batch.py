@@ -0,0 +1,97 @@
+import os
+import subprocess
+
+import pytest
+from git import Repo
+
+from dataset.commit import get_diff, get_diffs
+from dataset.git_batch import BatchRepo
+
+GIT_ENV = {
+    **os.environ,
+    "GIT_AUTHOR_NAME": "a", "GIT_AUTHOR_EMAIL": "a@example.com",
+    "GIT_COMMITTER_NAME": "c", "GIT_COMMITTER_EMAIL": "c@example.com",
+}
+
+
+def git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, env=GIT_ENV, check=True, stdout=subprocess.PIPE,
+                          text=True).stdout.strip()
+
+
+def write_file(repo, path, content):
+    path = os.path.join(repo, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """A repository whose commits add, modify, delete, rename and merge files."""
+    path = str(tmp_path / "repo")
+    git(tmp_path, "init", "--quiet", "-b", "master", path)
+    write_file(path, "sw/a.cxx", b"".join(b"line %d\n" % i for i in range(40)))
+    write_file(path, "sw/b.cxx", b"int b;\n")
+    write_file(path, "old.txt", b"".join(b"old %d\n" % i for i in range(20)))
+    git(path, "add", "-A")
+    git(path, "commit", "--quiet", "-m", "base\n\nDetails.")
+
+    write_file(path, "sw/a.cxx", b"line 0\nchanged\n" + b"".join(b"line %d\n" % i for i in range(3, 40)) + b"end\n")
+    write_file(path, "vcl/new.cxx", b"int n;\n")
+    write_file(path, "image.png", b"\x89PNG\x00\x01\x02")
+    git(path, "rm", "--quiet", "sw/b.cxx")
+    git(path, "mv", "old.txt", "new.txt")
+    git(path, "add", "-A")
+    git(path, "commit", "--quiet", "-m", "tdf#1 change files")
+
+    git(path, "checkout", "--quiet", "-b", "side", "HEAD~1")
+    write_file(path, "side.txt", b"side\n")
+    git(path, "add", "-A")
+    git(path, "commit", "--quiet", "-m", "side")
+    git(path, "checkout", "--quiet", "master")
+    git(path, "merge", "--quiet", "--no-edit", "side")
+    return path
+
+
+def diff_fields(diff):
+    return diff.a_path, diff.b_path, diff.new_file, diff.deleted_file, diff.renamed_file, diff.change_type, diff.diff
+
+
+def test_backends(repo):
+    gitpython = Repo(repo)
+    batch = BatchRepo(repo)
+    revs = git(repo, "rev-list", "--topo-order", "HEAD").split()
+    assert len(revs) == 4
+
+    for rev in revs:
+        expected = gitpython.commit(rev)
+        commit = batch.commit(rev)
+        assert commit.hexsha == expected.hexsha
+        assert [parent.hexsha for parent in commit.parents] == [parent.hexsha for parent in expected.parents]
+        assert commit.author == (expected.author.name, expected.author.email)
+        assert commit.committer == (expected.committer.name, expected.committer.email)
+        assert commit.authored_datetime == expected.authored_datetime
+        assert commit.committed_datetime == expected.committed_datetime
+        assert commit.message == expected.message
+        assert commit.summary == expected.summary
+        assert commit.stats.files == expected.stats.files
+        if not expected.parents:
+            continue
+
+        diffs = get_diffs(commit)
+        expected_diffs = get_diffs(expected)
+        assert diffs.keys() == expected_diffs.keys()
+        for file, diff in diffs.items():
+            assert diff_fields(diff) == diff_fields(expected_diffs[file])
+            assert diff.change_type is None
+
+        for file in expected.stats.files:
+            # Renamed files are diffed alone, with rename detection.
+            diff = get_diff(commit, diffs, file)
+            expected_diff = get_diff(expected, expected_diffs, file)
+            assert diff_fields(diff) == diff_fields(expected_diff)
+            if file in diffs and not diff.deleted_file:
+                assert (commit.tree / file).data_stream.read() == (expected.tree / file).data_stream.read()
+
+    batch.close()
@@ -0,0 +1,77 @@
+import os
+import subprocess
+
+import pytest
+
+from dataset.git_fetch import FetchManager
+
+GIT_ENV = {
+    **os.environ,
+    "GIT_AUTHOR_NAME": "a", "GIT_AUTHOR_EMAIL": "a@example.com",
+    "GIT_COMMITTER_NAME": "a", "GIT_COMMITTER_EMAIL": "a@example.com",
+}
+
+
+def git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, env=GIT_ENV, check=True, stdout=subprocess.PIPE,
+                          text=True).stdout.strip()
+
+
+@pytest.fixture
+def repos(tmp_path):
+    """A bare remote with a master branch and a change ref per commit, and a clone without the changes."""
+    work = str(tmp_path / "work")
+    remote = str(tmp_path / "remote.git")
+    local = str(tmp_path / "local")
+    git(tmp_path, "init", "--quiet", "-b", "master", work)
+    with open(os.path.join(work, "file.txt"), "w") as f:
+        f.write("base\n")
+    git(work, "add", "file.txt")
+    git(work, "commit", "--quiet", "-m", "base")
+    git(tmp_path, "clone", "--quiet", "--bare", work, remote)
+
+    changes = {}
+    for i in range(6):
+        with open(os.path.join(work, "file.txt"), "w") as f:
+            f.write(f"change {i}\n")
+        git(work, "commit", "--quiet", "-a", "-m", f"change {i}")
+        sha = git(work, "rev-parse", "HEAD")
+        git(work, "push", "--quiet", remote, f"HEAD:refs/changes/{i:02d}/1000{i}/1")
+        changes[f"refs/changes/{i:02d}/1000{i}/1"] = sha
+        git(work, "reset", "--quiet", "--hard", "HEAD~1")
+
+    git(tmp_path, "clone", "--quiet", "--no-local", remote, local)
+    return local, changes
+
+
+def test_fetch(repos):
+    local, changes = repos
+    missing_ref = "refs/changes/99/99999/1"
+    refs = list(changes)
+    refs.insert(3, missing_ref)
+
+    fetch_manager = FetchManager(local, batch_size=4, jobs=2)
+    assert fetch_manager.missing(changes.values()) == set(changes.values())
+
+    # The first batch has the missing ref, so it is split until only that ref fails.
+    assert fetch_manager.fetch(refs) == set(changes)
+    assert fetch_manager.fetched == set(changes)
+    assert fetch_manager.failed == {missing_ref}
+    assert fetch_manager.fetch_count > 2
+    assert fetch_manager.missing(changes.values()) == set()
+
+
+def test_fetch_missing(repos):
+    local, changes = repos
+    refs = list(changes)
+
+    fetch_manager = FetchManager(local, batch_size=2, jobs=1)
+    assert fetch_manager.fetch_missing((ref, changes[ref]) for ref in refs[:3]) == set(refs[:3])
+    assert fetch_manager.fetch_count == 2
+
+    # Only the commits which aren't in the repository yet are fetched.
+    assert fetch_manager.fetch_missing((ref, changes[ref]) for ref in refs) == set(refs[3:])
+    assert fetch_manager.fetch_count == 4
+    assert fetch_manager.fetch_missing((ref, changes[ref]) for ref in refs) == set()
+    assert fetch_manager.fetch_count == 4
+    assert fetch_manager.failed == set()
@@ -0,0 +1,61 @@
+import multiprocessing as mp
+import os
+
+import orjson
+import pytest
+import zstandard
+
+from dataset.metrics_cache import MetricsCache
+
+
+def get_value(i):
+    return {"metrics": {"sloc": i, "names": [f"function{i}_{j}" for j in range(100)]}}
+
+
+def disk_size(cache):
+    return sum(entry.stat().st_size for entry in cache._entries())
+
+
+def test_metrics_cache(tmp_path):
+    cache = MetricsCache(str(tmp_path))
+    cache.put("ab01", get_value(1))
+    assert cache.get("ab01") == get_value(1)
+    assert cache.get("ab02") is None
+    assert cache.get_stats()["hits"] == 1
+
+    # Overwriting an entry doesn't count it twice.
+    cache.put("ab01", get_value(1))
+    assert cache.size == disk_size(cache)
+
+
+def test_metrics_cache_shared_size(tmp_path, monkeypatch):
+    caches = [MetricsCache(str(tmp_path)) for _ in range(2)]
+    entry_size = len(zstandard.ZstdCompressor().compress(orjson.dumps(get_value(0))))
+    for cache in caches:
+        cache.max_size = entry_size * 10
+
+    # Each instance acts as a different process writing to the same cache.
+    for i in range(40):
+        caches[i % 2].put(f"{i:04x}", get_value(i))
+        assert disk_size(caches[0]) <= caches[0].max_size
+    assert caches[0].size == caches[1].size == disk_size(caches[0])
+
+    # The size is read from the sidecar file rather than scanned.
+    monkeypatch.setattr(MetricsCache, "_scan_size", lambda self: pytest.fail("scanned the entries"))
+    cache = MetricsCache(str(tmp_path))
+    assert cache.size == disk_size(cache)
+
+
+def put_values(path, start):
+    cache = MetricsCache(path, max_size=20000)
+    for i in range(start, start + 100):
+        cache.put(f"{i:04x}", get_value(i))
+
+
+def test_metrics_cache_processes(tmp_path):
+    with mp.Pool(4) as pool:
+        pool.starmap(put_values, [(str(tmp_path), start) for start in range(0, 400, 100)])
+
+    cache = MetricsCache(str(tmp_path))
+    assert cache.size == disk_size(cache) <= 20000
+    assert os.path.exists(cache.size_path)
@@ -0,0 +1,96 @@
+import importlib.util
+import json
+import os
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import HTTPServer
+
+import pytest
+
+from conftest import ROOT
+
+# test.py would be shadowed by the test package of the standard library.
+spec = importlib.util.spec_from_file_location("classify", os.path.join(ROOT, "test.py"))
+classify = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(classify)
+
+
+def test_get_repo(tmp_path):
+    classifier = object.__new__(classify.CommitClassifier)
+    classifier.repos = OrderedDict()
+
+    paths = []
+    for i in range(classify.REPO_CACHE_SIZE + 1):
+        path = str(tmp_path / f"repo{i}")
+        subprocess.run(["git", "init", "--quiet", path], check=True)
+        paths.append(path)
+
+    repos = [classifier.get_repo(path) for path in paths[:-1]]
+    # Using the first repository again makes the second one the least recently used.
+    assert classifier.get_repo(paths[0]) is repos[0]
+    classifier.get_repo(paths[-1])
+
+    assert list(classifier.repos) == paths[2:-1] + [paths[0], paths[-1]]
+
+
+class FakeClassifier:
+    def __init__(self):
+        self.paths = []
+
+    def classify(self, revision, save, csv_path, id, save_path, repo_dir):
+        self.paths.append((csv_path, save_path))
+        return 1 if revision == "fail" else 0
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(classify.ClassifierRequestHandler, "classifier", FakeClassifier())
+    monkeypatch.setattr(classify.ClassifierRequestHandler, "output_root", str(tmp_path / "root"))
+    server = HTTPServer(("127.0.0.1", 0), classify.ClassifierRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(f"{url}/classify", data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_classify_request(server):
+    assert post(server, json.dumps({"revision": "fail"}).encode()) == (200, {"returncode": 1})
+    assert post(server, b"") == (200, {"returncode": 0})
+
+    for body in (b"{", b"[]", b"\xff"):
+        code, response = post(server, body)
+        assert code == 400
+        assert "error" in response
+
+
+def test_classify_paths(server, tmp_path):
+    root = tmp_path / "root"
+    os.makedirs(root / "gerrit")
+    os.symlink(tmp_path, root / "link")
+    paths = classify.ClassifierRequestHandler.classifier.paths
+
+    assert post(server, b"{}") == (200, {"returncode": 0})
+    assert post(server, json.dumps({"csv": "gerrit", "save_path": str(root / "gerrit" / "..")}).encode()) == (
+        200, {"returncode": 0}
+    )
+    assert paths == [(str(root), str(root)), (str(root / "gerrit"), str(root))]
+
+    for request in ({"csv": ".."}, {"save_path": str(tmp_path)}, {"csv": "/etc"}, {"save_path": "link"},
+                    {"csv": "gerrit/../../root2"}, {"save_path": 1}):
+        code, response = post(server, json.dumps(request).encode())
+        assert code == 400
+        assert "error" in response
+    assert len(paths) == 2
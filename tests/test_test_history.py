@@ -0,0 +1,128 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from conftest import ROOT, TESTS
+from dataset.db import write
+
+
+def get_commits(count):
+    return [
+        {
+            "node": f"{i:040x}",
+            "failures": [TESTS[i % len(TESTS)]] if i % 2 == 0 else [],
+            "types": ["C++"],
+            "files": [f"sw/source/file{i % 5}.cxx"],
+            "directories": ["sw", "sw/source"],
+            "components": ["Writer"],
+        }
+        for i in range(count)
+    ]
+
+
+def test_generate_history_script(data_dir):
+    commits = get_commits(20)
+    write(commits, "data/commits.json")
+
+    # The DBs are written with the classes of test_history as `__main__` members.
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, "dataset", "test_history.py")],
+        check=True,
+        env={**os.environ, "PYTHONPATH": ROOT},
+    )
+
+    from dataset import test_history
+
+    past_failures = test_history.PastFailuresCache().get()
+    assert isinstance(past_failures, test_history.PastFailures)
+    assert past_failures["push_num"] == len(commits)
+    assert past_failures["all_runnables"] == TESTS
+    row = past_failures.get_row(f"all${TESTS[0]}$all")
+    assert past_failures.read(row, 1) == sum(1 for commit in commits if TESTS[0] in commit["failures"])
+
+    stats = test_history.load_failing_together_stats()
+    assert isinstance(stats, test_history.FailingTogetherStats)
+    assert stats.nodes == [commit["node"] for commit in commits]
+    count_single, _ = stats.counts()
+    assert count_single.tolist() == [
+        sum(1 for commit in commits if test in commit["failures"]) for test in sorted(TESTS)
+    ]
+
+
+def test_past_failures_dict(data_dir):
+    from dataset import test_history
+
+    past_failures = test_history.PastFailures()
+    past_failures["push_num"] = 3
+    for i in range(3):
+        past_failures.write(past_failures.add(f"file$test${i}", i), i + 1, i + 1)
+
+    loaded = test_history.PastFailures.from_dict(past_failures.to_dict())
+    assert loaded["push_num"] == 3
+    assert [loaded.read(loaded.get_row(f"file$test${i}"), i + 1) for i in range(3)] == [1, 2, 3]
+    # The loaded DB can keep growing.
+    loaded.write(loaded.add("file$test$3", 4), 4, 1)
+    assert loaded.read(loaded.get_row("file$test$3"), 4) == 1
+
+
+def test_failing_together_stats_dict(data_dir):
+    from dataset import test_history
+
+    stats = test_history.FailingTogetherStats(sorted(TESTS), checkpoint_interval=4)
+    commits = get_commits(10)
+    for commit in commits:
+        stats.add(commit)
+
+    loaded = test_history.FailingTogetherStats.from_dict(stats.to_dict())
+    for end in (None, 3, 4, 9):
+        for expected, actual in zip(stats.counts(end), loaded.counts(end)):
+            assert np.array_equal(expected, actual)
+
+    # Rewriting the history from the loaded statistics.
+    assert loaded.feed(5, {"node": "rewritten", "failures": TESTS})
+    assert len(loaded) == 6
+    assert loaded.counts()[0].tolist() == [sum(counts) for counts in zip(*(
+        [int(test in commit["failures"]) for test in sorted(TESTS)] for commit in commits[:5] + [{"failures": TESTS}]
+    ))]
+
+
+def test_read_test_scheduling_shards(data_dir):
+    from dataset import test_history
+
+    commits = get_commits(20)
+    write(commits, "data/commits.json")
+    test_history.generate_history("data/commits.json", jobs=2, shard_size=3)
+
+    assert len(test_history.get_test_scheduling_paths()) == 1 + 7
+    items = list(test_history.read_test_scheduling())
+    assert [item["revs"][0] for item in items] == [commit["node"] for commit in commits]
+    assert list(test_history.read_test_scheduling(parallel=True)) == items
+
+
+def test_past_failures_cache(data_dir):
+    from dataset import test_history
+
+    past_failures = test_history.PastFailures()
+    past_failures["push_num"] = 1
+    write([past_failures.to_dict()], test_history.PAST_FAILURES_PATH)
+
+    cache = test_history.PastFailuresCache()
+    loaded = cache.get()
+    assert loaded["push_num"] == 1
+    assert cache.get() is loaded
+    assert cache.loads == 1
+
+    # Same size, but a different modification time.
+    stat = os.stat(test_history.PAST_FAILURES_PATH)
+    os.utime(test_history.PAST_FAILURES_PATH, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get() is not loaded
+    assert cache.loads == 2
+
+    past_failures["push_num"] = 2
+    past_failures.add("all$test$all", 0)
+    write([past_failures.to_dict()], test_history.PAST_FAILURES_PATH)
+    assert cache.get()["push_num"] == 2
+    assert cache.get()["push_num"] == 2
+    assert cache.loads == 3
@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+from conftest import TESTS
+from dataset import commit_features, test_history
+from dataset.db import write
+from models.testselect import TestLabelSelectModel
+
+SIZE_KEYS = [
+    f"{kind}_{size}" for kind in ("source_code", "other", "test")
+    for size in ("files_modified_num", "added", "deleted")
+] + [
+    f"{stat}_{kind}_file_size" for kind in ("source_code", "other", "test")
+    for stat in ("total", "maximum", "minimum")
+]
+
+
+def get_commit(i):
+    return {
+        "node": f"{i:040x}",
+        "pushdate": "2023-06-12 00:00:00",
+        "failures": [TESTS[i % len(TESTS)]] if i % 3 == 0 else [],
+        "types": ["C++"],
+        "files": [f"sw/source/file{i % 4}.cxx"],
+        "directories": ["sw", "sw/source"],
+        "components": ["Writer"],
+        "reviewers": [],
+        **{key: i % 5 for key in SIZE_KEYS},
+    }
+
+
+@pytest.fixture
+def model(data_dir, monkeypatch):
+    """A TestLabelSelectModel with a tiny classifier fitted on the history of a few commits."""
+    monkeypatch.setattr(test_history, "PAST_FAILURES", test_history.PastFailuresCache())
+    write([get_commit(i) for i in range(30)], "data/commits.json")
+    test_history.generate_history("data/commits.json")
+
+    model = TestLabelSelectModel()
+    items = list(model.items_gen())
+    X = model.extraction_pipeline.fit_transform(lambda: (item for item, _ in items))
+    model.clf = LogisticRegression().fit(X, [label for _, label in items])
+    return model
+
+
+def predict(model, commits, push_num):
+    """Predict the failure probability of each runnable of a push, one row at a time."""
+    past_failures = test_history.PAST_FAILURES.get()
+    commit_data = commit_features.merge_commits(commits)
+    probs = {}
+    for data in test_history.generate_data(past_failures, commit_data, push_num, past_failures["all_runnables"], []):
+        X = model.extraction_pipeline.transform(lambda: [dict(commit_data, test_job=data)])
+        probs[data["name"]] = math.floor(model.clf.predict_proba(X)[0, 1] * 100) / 100
+    return probs
+
+
+def test_select_tests_batch(model):
+    pushes = [([get_commit(i)], 20 + i) for i in (0, 1, 3, 4)] + [([get_commit(5), get_commit(6)], None)]
+    next_push_num = test_history.PAST_FAILURES.get()["push_num"] + 1
+
+    selected = model.select_tests_batch(pushes, confidence=0.0)
+    assert selected == [model.select_tests(commits, 0.0, push_num) for commits, push_num in pushes]
+    assert selected == [
+        predict(model, commits, push_num if push_num is not None else next_push_num) for commits, push_num in pushes
+    ]
+    assert all(list(probs) == sorted(TESTS) for probs in selected)
+    # The pushes get different probabilities, so they can't be mixed up.
+    assert len({tuple(probs.values()) for probs in selected}) > 1
+
+    confidence = float(np.median([prob for probs in selected for prob in probs.values()]))
+    assert model.select_tests_batch(pushes, confidence) == [
+        {test: prob for test, prob in probs.items() if prob >= confidence} for probs in selected
+    ]
+
+
+def test_select_tests_batch_empty(model):
+    assert model.select_tests_batch([]) == []
@@ -59,11 +59,9 @@ class Trainer(object):
 
         logger.info("Model compressed")
 
+        # The dataset is left uncompressed, so that it can be memory-mapped and reused by the next training.
         if model_obj.store_dataset:
-            assert os.path.exists(f"{model_file_name}_data_X")
-            zstd_compress(f"{model_file_name}_data_X")
-            assert os.path.exists(f"{model_file_name}_data_y")
-            zstd_compress(f"{model_file_name}_data_y")
+            assert os.path.exists(f"{model_file_name}_data_y.npy")
 
 
 def parse_args(args):
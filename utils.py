@@ -1,12 +1,14 @@
 # Created by Baole Fang at 6/17/23
 import errno
+import hashlib
 import json
 import os
-import subprocess
+import shutil
 from collections import deque
 from dataset import db
 import numpy as np
 import scipy
+import zstandard
 from sklearn.base import BaseEstimator, TransformerMixin
 
 
@@ -39,11 +41,14 @@ class CustomJsonEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
-def zstd_compress(path: str) -> None:
+def zstd_compress(path: str, level: int = db.ZSTD_LEVEL, threads: int = -1) -> None:
+    """Compress a file to `path.zst`, like `zstd -f path` but in process and with all CPUs by default."""
     if not os.path.exists(path):
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
-    subprocess.run(["zstd", "-f", path], check=True)
+    cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+    with open(path, "rb") as input_f, open(f"{path}.zst", "wb") as output_f:
+        cctx.copy_stream(input_f, output_f, size=os.path.getsize(path))
 
 
 def split_tuple_generator(generator):
@@ -70,12 +75,76 @@ def to_array(val):
     return val
 
 
+CSR_COMPONENTS = ("data", "indices", "indptr", "shape")
+
+
+def save_matrix(path: str, matrix) -> None:
+    """Save a matrix so that `load_matrix` can memory-map it.
+
+    Dense arrays are saved to `path.npy`, CSR matrices to a `path` directory with one `.npy`
+    file per component (data, indices, indptr and shape).
+    """
+    remove_matrix(path)
+    if isinstance(matrix, scipy.sparse.spmatrix):
+        matrix = matrix.tocsr()
+        os.makedirs(path)
+        for component in CSR_COMPONENTS:
+            np.save(os.path.join(path, f"{component}.npy"), np.asarray(getattr(matrix, component)),
+                    allow_pickle=False)
+    else:
+        np.save(f"{path}.npy", np.asarray(matrix), allow_pickle=False)
+
+
+def load_matrix(path: str, mmap_mode: str = "r"):
+    """Load a matrix saved by `save_matrix`, memory-mapping its arrays with `mmap_mode`."""
+    if os.path.isdir(path):
+        data, indices, indptr, shape = (
+            np.load(os.path.join(path, f"{component}.npy"), mmap_mode=mmap_mode if component != "shape" else None)
+            for component in CSR_COMPONENTS
+        )
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+
+    return np.load(f"{path}.npy", mmap_mode=mmap_mode)
+
+
+def remove_matrix(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(f"{path}.npy"):
+        os.remove(f"{path}.npy")
+
+
+def hash_files(paths, digest=None, chunk_size: int = 1024 ** 2):
+    """Hash the names and the contents of files, or the lack of them for those which don't exist.
+
+    The files of a block store's index and of directories are hashed along with them.
+    """
+    digest = digest if digest is not None else hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode("utf-8") + b"\0")
+        if os.path.isdir(path):
+            hash_files(sorted(os.path.join(path, name) for name in os.listdir(path)), digest, chunk_size)
+            continue
+        if not os.path.exists(path):
+            digest.update(b"missing\0")
+            continue
+
+        digest.update(str(os.path.getsize(path)).encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+
+        if os.path.exists(f"{path}.index"):
+            hash_files([f"{path}.index"], digest, chunk_size)
+    return digest
+
+
 def get_physical_cpu_count() -> int:
     return os.cpu_count() // 2
 
 
-def read_commits(path='data/commits.json'):
-    return db.read(path)
+def read_commits(path='data/commits.json', columns=None):
+    return db.read(path, columns)
 
 
 class Converter(BaseEstimator, TransformerMixin):
@@ -90,11 +159,19 @@ class Converter(BaseEstimator, TransformerMixin):
 
 
 def get_commit_map(
-        revs=None, path='data/commits.json'
+        revs=None, path='data/commits.json', columns=None
 ):
+    if revs is not None and path.endswith('.block'):
+        # Only decompress the blocks of the revisions.
+        commit_map = db.BlockStore(path).get_many(revs)
+        if columns is not None:
+            commit_map = dict(zip(commit_map, db.project(commit_map.values(), columns)))
+        assert len(commit_map) > 0
+        return commit_map
+
     commit_map = {}
 
-    for commit in read_commits(path):
+    for commit in read_commits(path, columns):
         if revs is not None and commit["node"] not in revs:
             continue
 